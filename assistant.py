@@ -9,7 +9,6 @@ full_start_time = time.perf_counter()
 # import audioop
 from datetime import datetime
 # import whisper
-from faster_whisper import WhisperModel
 import ffmpeg
 import openai #0.28.0
 import pyaudio
@@ -35,6 +34,8 @@ import functions as funcs
 import listening
 import vision as eyes
 import embeddings as emb
+import metrics
+import whisper_models
 
 if not opts.verbosity:
     os.system('cls' if os.name=='nt' else 'clear')
@@ -320,6 +321,7 @@ def handle_command(command):
         case 'reset':
             opts.message_array = []
             opts.message_array = opts.example_messages.copy()
+            opts.conversation_summary = ""
             print(f'$ Messages cleared!')
             vrc.chatbox('🗑️ Cleared message buffer')
             funcs.play_sound('./prebaked_tts/Clearedmessagebuffer.wav')
@@ -410,6 +412,18 @@ def handle_command(command):
             funcs.play_sound('./prebaked_tts/Configurationsaved.wav')
             vrc.chatbox('💾 Configuration saved')
 
+        case 'exportmetrics':
+            metrics.export_json('metrics.json')
+            metrics.export_csv('metrics.csv')
+            for key, summary in metrics.summary().items():
+                ttft = f'{summary["time_to_first_token_p50"]:.3f}s' if summary["time_to_first_token_p50"] is not None else "n/a"
+                tokens_per_second = f'{summary["tokens_per_second_p50"]:.1f}' if summary["tokens_per_second_p50"] is not None else "n/a"
+                print(f'$ {key}: {summary["requests"]} requests, {summary["errors"]} errors, median first token {ttft}, median {tokens_per_second} tok/s')
+            for api_base, stats in chatgpt.get_backend_stats().items():
+                ttft = f'{stats["ttft_p50"]:.3f}s / {stats["ttft_p90"]:.3f}s' if stats["ttft_p50"] is not None else "n/a"
+                print(f'$ {api_base}: {stats["requests"]} requests, {stats["errors"]} errors, {stats["hedge_wins"]} hedges won, first token p50/p90 {ttft}')
+            vrc.chatbox('📊 Metrics exported')
+
         case 'loadconfig':
             opts.load_config()
             ui.app.refresh_all()
@@ -467,6 +481,7 @@ def check_doublepress_key(key):
         if opts.speaking or opts.generating: 
             print('Panicking')
             opts.panic = True
+            chatgpt.cancel_generation()
             vrc.chatbox('⚠ Panicking')
         if time.time() > key_press_window_timeup:
             key_press_window_timeup = time.time() + opts.key_press_window
@@ -477,16 +492,10 @@ def check_doublepress_key(key):
 
 # (thread target) Initialize Faster Whisper and move its model to the GPU if possible
 def load_whisper():
-    with opts.whisper_lock:
-        funcs.v_print("~Attempt to load Whisper...")
-        # vrc.chatbox('🔄 Loading Voice Recognition...')
-        model = None
-        start_time = time.perf_counter()
-        model = WhisperModel(opts.whisper_model_size, device=opts.whisper_device, compute_type=opts.whisper_compute_type) # FasterWhisper
-        opts.whisper_model = model
-        end_time = time.perf_counter()
-        funcs.v_print(f'--Whisper loaded in {end_time - start_time:.3f}s')
-        # vrc.chatbox('✔️ Voice Recognition Loaded')
+    funcs.v_print("~Attempt to load Whisper...")
+    # vrc.chatbox('🔄 Loading Voice Recognition...')
+    whisper_models.load_model() # FasterWhisper
+    # vrc.chatbox('✔️ Voice Recognition Loaded')
 
 def load_whisperX() -> None:
     with opts.whisper_lock:
@@ -723,8 +732,12 @@ def loop3():
                     if ui.app.ai_stuff_frame.manual_entry_window_is_open.get() == True:
                         ui.app.ai_stuff_frame.manual_entry_window.refresh_messages()
 
+                    speech = None
                     if opts.parrot_mode:
                         text = last_message
+                    elif opts.stream_tts:
+                        speech = funcs.SpeechStream()
+                        text = chatgpt.generate(speech=speech)
                     else: 
                         text = chatgpt.generate()
                     vrc.set_parameter(opts.vrc_thinking_parameter.get("name"), opts.vrc_thinking_parameter.get("value_off"))
@@ -732,12 +745,16 @@ def loop3():
 
                     if text is None: 
                         funcs.v_print("!!No text returned from LLM")
+                        if speech is not None:
+                            speech.cancel()
                     else:
                         if ui.app.ai_stuff_frame.manual_entry_window_is_open.get() == True:
                             ui.app.ai_stuff_frame.manual_entry_window.refresh_messages()
                             ui.app.ai_stuff_frame.manual_entry_window.button_send.configure(text="Send", state="normal")
                             ui.app.ai_stuff_frame.manual_entry_window.textfield_text_entry.configure(state="normal")
-                        if opts.chatbox and len(text) > 140:
+                        if speech is not None and speech.finish():
+                            pass # already spoken sentence by sentence while it was being generated
+                        elif opts.chatbox and len(text) > 140:
                             funcs.cut_up_text(text)
                         else:
                             with opts.is_speaking_lock:
@@ -0,0 +1,69 @@
+# bench_audio_buffer.py (c) 2024 MissingNO123
+# Description: Micro-benchmark for the audio buffer of OnlineASRProcessor in whisper_online.py. It replays a long listening session of small chunks, trimming the buffer the way chunk_at does, and compares np.append and slicing against the preallocated AudioBuffer for insert, trim and view.
+
+import argparse
+import time
+
+import numpy as np
+
+import metrics
+from whisper_online import AudioBuffer, OnlineASRProcessor
+
+
+class AppendBuffer:
+    """ The old way: np.append copies the whole buffer on every insert, and trimming keeps a slice of the old array """
+    def __init__(self):
+        self.audio = np.array([], dtype=np.float32)
+
+    def __len__(self):
+        return len(self.audio)
+
+    def append(self, audio):
+        self.audio = np.append(self.audio, audio)
+
+    def trim(self, samples):
+        self.audio = self.audio[samples:]
+
+    def view(self):
+        return self.audio
+
+
+def run_session(buffer, chunks: int, chunk: np.ndarray, trim_samples: int, keep_samples: int) -> dict:
+    timings = {"insert": [], "trim": [], "view": []}
+    checksum = 0.0
+    for _ in range(chunks):
+        start_time = time.perf_counter()
+        buffer.append(chunk)
+        timings["insert"].append(time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        audio = buffer.view()
+        timings["view"].append(time.perf_counter() - start_time)
+        checksum += float(audio[-1]) # touch the view like transcribe would
+        if len(buffer) > trim_samples:
+            start_time = time.perf_counter()
+            buffer.trim(len(buffer) - keep_samples)
+            timings["trim"].append(time.perf_counter() - start_time)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--minutes', type=float, default=30, help="Length of the simulated listening session.")
+    parser.add_argument('--chunk_ms', type=float, default=100, help="Length of each inserted chunk in milliseconds.")
+    parser.add_argument('--trim_sec', type=float, default=15, help="Trim the buffer once it's longer than this, like buffer_trimming.")
+    parser.add_argument('--keep_sec', type=float, default=5, help="Seconds left in the buffer after a trim.")
+    args = parser.parse_args()
+
+    rate = OnlineASRProcessor.SAMPLING_RATE
+    chunk = np.random.default_rng(0).uniform(-1, 1, int(args.chunk_ms / 1000 * rate)).astype(np.float32)
+    chunks = int(args.minutes * 60 * 1000 / args.chunk_ms)
+    print(f"{chunks} chunks of {args.chunk_ms:.0f}ms ({args.minutes} minutes), trimming to {args.keep_sec}s past {args.trim_sec}s")
+    for name, buffer in (("np.append", AppendBuffer()), ("AudioBuffer", AudioBuffer(2 * (args.trim_sec + 15) * rate))):
+        start_time = time.perf_counter()
+        timings = run_session(buffer, chunks, chunk, int(args.trim_sec * rate), int(args.keep_sec * rate))
+        total_time = time.perf_counter() - start_time
+        print(f"{name:<12} total {total_time:7.3f}s", end='')
+        for op, values in timings.items():
+            if len(values) > 0:
+                print(f"  {op} mean {sum(values) / len(values) * 1e6:7.2f}us p99 {metrics.percentile(values, 99) * 1e6:7.2f}us", end='')
+        print()
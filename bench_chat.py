@@ -0,0 +1,96 @@
+# bench_chat.py (c) 2024 MissingNO123
+# Description: Benchmark for the chat path in chatgpt.py. It runs chatgpt.generate (or chatgpt.call_function) against the local mock server from mock_llm_server.py, and subtracts the time the server spent simulating the generation, so what's left is the overhead of our own code per request and per token.
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+from typing import List
+
+import openai
+
+import options as opts
+import chatgpt
+import metrics
+import mock_llm_server as mock
+
+
+def report(name: str, values: List[float], unit_scale: float = 1000, unit: str = "ms") -> None:
+    if len(values) == 0:
+        print(f"{name:<26} n/a")
+        return
+    print(f"{name:<26} mean {sum(values) / len(values) * unit_scale:8.3f}{unit}  p50 {metrics.percentile(values, 50) * unit_scale:8.3f}{unit}  p99 {metrics.percentile(values, 99) * unit_scale:8.3f}{unit}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=50, help="Number of requests to time.")
+    parser.add_argument('--warmup', type=int, default=3, help="Untimed requests to send first.")
+    parser.add_argument('--mode', type=str, default="generate", choices=["generate", "call_function"], help="Drive generate, or call_function followed by the follow-up reply.")
+    parser.add_argument('--client', type=str, default="async" if opts.use_async_client else "openai", choices=["async", "openai"], help="Stream with the aiohttp client or openai.ChatCompletion.")
+    parser.add_argument('--show_output', action="store_true", default=False, help="Print the streamed replies to the console, which is part of the overhead.")
+    parser.add_argument('--hedge_ttft', type=float, default=None, help="Start a second mock server with this time to first token and hedge with it.")
+    mock.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = mock.server_from_arguments(args, 0).start()
+    servers = [server]
+    opts.gpt = "custom"
+    opts.custom_api_url = server.url
+    opts.custom_model_name = server.model
+    opts.use_async_client = args.client == "async"
+    opts.chatbox = False
+    opts.enable_tools = len(args.tool_calls) > 0
+    opts.metrics_enabled = True
+    opts.metrics_history = max(opts.metrics_history, args.requests)
+    openai.api_key = openai.api_key or "mock"
+    chatgpt.update_base_url()
+    if args.hedge_ttft is not None:
+        secondary = mock.server_from_arguments(args, 0, ttft=args.hedge_ttft).start()
+        servers.append(secondary)
+        opts.hedge_enabled = True
+        opts.hedge_api_url = secondary.url
+    print(f"Mock server: ttft {args.ttft}s, {args.tokens_per_second} tok/s, {args.tokens} tokens, {args.client} client, mode {args.mode}")
+
+    overheads = []
+    token_overheads = []
+    totals = []
+    output = sys.stdout if args.show_output else open(os.devnull, 'w')
+    for i in range(args.warmup + args.requests):
+        opts.message_array = [{"role": "user", "content": f"Hey, this is benchmark message number {i}, how are you doing?"}]
+        times_before = [len(s.request_times) for s in servers]
+        history_before = len(metrics.get_history())
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(output):
+            if args.mode == "generate":
+                result = chatgpt.generate()
+            else:
+                result = chatgpt.call_function({"name": "get_user_count", "arguments": "{}"})
+        total_time = time.perf_counter() - start_time
+        if result is None:
+            print(f"!!Request {i} failed")
+            continue
+        if i < args.warmup:
+            continue
+        entries = metrics.get_history()[history_before:]
+        # when hedging both servers can finish a request, the faster one is the one that was read
+        server_time = min(sum(s.request_times[before:]) for s, before in zip(servers, times_before) if len(s.request_times) > before)
+        tokens = sum(entry["completion_tokens"] or 0 for entry in entries)
+        overhead = total_time - server_time
+        totals.append(total_time)
+        overheads.append(overhead)
+        if tokens > 0:
+            token_overheads.append(overhead / tokens)
+    for s in servers:
+        s.stop()
+
+    history = metrics.get_history()[-args.requests:]
+    print(f"{len(totals)} requests, {server.requests} sent to the server")
+    report("total per request", totals)
+    report("overhead per request", overheads)
+    report("overhead per token", token_overheads, 1e6, "us")
+    report("prompt build", [entry["prompt_build_time"] for entry in history if entry["prompt_build_time"] is not None])
+    report("retrieval", [entry["retrieval_time"] for entry in history if entry["retrieval_time"] is not None])
+    report("time to first token", [entry["time_to_first_token"] for entry in history if entry["time_to_first_token"] is not None])
+    report("inter-token p50", [entry["inter_token_p50"] for entry in history if entry["inter_token_p50"] is not None])
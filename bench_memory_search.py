@@ -0,0 +1,100 @@
+# bench_memory_search.py (c) 2024 MissingNO123
+# Description: Benchmark for the memory search in embeddings.py. It fills the memory store with synthetic clustered embeddings (or the real memory.json), then compares the approximate IVF index against exact brute force search, reporting recall@k and per-query latency for a range of probe counts.
+
+import argparse
+import shutil
+import tempfile
+import time
+from typing import List
+
+import torch
+import torch.nn.functional as F
+
+import options as opts
+import embeddings as emb
+import metrics
+
+
+def synthetic_embeddings(count: int, dim: int, clusters: int, noise: float, seed: int):
+    """ Returns normalized vectors scattered around random cluster centers, which is roughly what sentence embeddings of a topical corpus look like """
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(clusters, dim, generator=generator)
+    members = torch.randint(0, clusters, (count,), generator=generator)
+    return F.normalize(centers[members] + noise * torch.randn(count, dim, generator=generator), p=2, dim=1)
+
+
+def time_queries(queries, k: int, exact: bool) -> tuple[List[List[int]], List[float]]:
+    results = []
+    latencies = []
+    for query in queries:
+        start_time = time.perf_counter()
+        _, indices = emb._search_embeddings(query, k, exact=exact)
+        latencies.append(time.perf_counter() - start_time)
+        results.append(indices)
+    return results, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100000, help="Number of synthetic memory items to search over.")
+    parser.add_argument('--dim', type=int, default=768, help="Embedding dimension of the synthetic items.")
+    parser.add_argument('--clusters', type=int, default=2000, help="Number of topics the synthetic items are scattered around.")
+    parser.add_argument('--noise', type=float, default=0.6, help="How far items stray from their topic center.")
+    parser.add_argument('--queries', type=int, default=200, help="Number of queries to time.")
+    parser.add_argument('--k', type=int, default=emb.top_k, help="Number of results per query.")
+    parser.add_argument('--probes', type=str, default="4,8,16,32,64", help="Comma separated IVF probe counts to try.")
+    parser.add_argument('--real', action="store_true", default=False, help="Benchmark the real memory.json instead of synthetic items.")
+    parser.add_argument('--storage', type=str, default=opts.memory_storage, choices=["float32", "int8"], help="How memory embeddings are stored.")
+    parser.add_argument('--matryoshka_dim', type=int, default=opts.memory_matryoshka_dim, help="Truncate embeddings to this many dimensions, 0 = keep all.")
+    parser.add_argument('--no_rescore', action="store_true", default=False, help="Skip the float rescoring pass for int8 storage.")
+    args = parser.parse_args()
+
+    opts.memory_storage = args.storage
+    opts.memory_matryoshka_dim = args.matryoshka_dim
+    opts.memory_rescore = not args.no_rescore
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if args.real:
+        emb.model_ready.result()
+        emb.load_memory_from_file()
+        count = len(emb.memory)
+        sampled = emb._memory_rows(torch.randint(0, count, (args.queries,), device=emb.memory_embeddings.device))
+        queries = F.normalize(sampled + 0.05 * torch.randn_like(sampled), p=2, dim=1)
+    else:
+        data = synthetic_embeddings(args.items + args.queries, args.dim, args.clusters, args.noise, seed=0).to(device)
+        emb.memory.clear()
+        emb.memory_embeddings = None
+        emb.memory_scales = None
+        items = [f"item {i}" for i in range(args.items)]
+        # int8 rescoring reads the original float rows from the embedding cache, so the synthetic items go into a temporary one
+        emb.embedding_cache_dir = tempfile.mkdtemp(prefix="bench_memory_search_")
+        emb._write_embedding_cache([emb._content_hash(item) for item in items], data[:args.items].cpu().numpy())
+        emb._append_to_memory(items, data[:args.items])
+        count = args.items
+        queries = data[args.items:]
+    storage_bytes = emb.memory_embeddings[:count].nelement() * emb.memory_embeddings.element_size() + (count * 4 if emb.memory_scales is not None else 0)
+    print(f"Searching {count} items of dim {emb.memory_embeddings.shape[1]} stored as {args.storage} ({storage_bytes / 2**20:.1f} MiB) on {device}, top {args.k}, {args.queries} queries")
+
+    exact_results, exact_latencies = time_queries(queries, args.k, exact=True)
+    if args.real:
+        reference_results = exact_results
+    else:
+        # synthetic recall is measured against float32 search over the untruncated vectors, so the loss from compact storage shows up too
+        reference_results = [torch.topk(data[:args.items] @ query, k=min(args.k, count)).indices.tolist() for query in queries]
+    exact_recall = sum(len(set(a) & set(e)) / len(e) for a, e in zip(exact_results, reference_results) if len(e)) / len(reference_results)
+    print(f"exact      recall@{args.k} {exact_recall:.3f}  mean {sum(exact_latencies) / len(exact_latencies) * 1000:7.3f}ms  p50 {metrics.percentile(exact_latencies, 50) * 1000:7.3f}ms  p99 {metrics.percentile(exact_latencies, 99) * 1000:7.3f}ms")
+
+    opts.memory_index = "ivf"
+    emb.ivf_min_items = 0
+    start_time = time.perf_counter()
+    emb._rebuild_memory_index(wait=True)
+    print(f"IVF index with {emb.memory_index.list_count} lists built in {time.perf_counter() - start_time:.3f}s")
+    for probes in [int(p) for p in args.probes.split(",")]:
+        opts.memory_index_probes = probes
+        ivf_results, ivf_latencies = time_queries(queries, args.k, exact=False)
+        recall = sum(len(set(a) & set(e)) / len(e) for a, e in zip(ivf_results, reference_results) if len(e)) / len(reference_results)
+        print(f"ivf p={probes:<4} recall@{args.k} {recall:.3f}  mean {sum(ivf_latencies) / len(ivf_latencies) * 1000:7.3f}ms  p50 {metrics.percentile(ivf_latencies, 50) * 1000:7.3f}ms  p99 {metrics.percentile(ivf_latencies, 99) * 1000:7.3f}ms")
+
+    if not args.real:
+        emb.rescore_source = None
+        shutil.rmtree(emb.embedding_cache_dir, ignore_errors=True)
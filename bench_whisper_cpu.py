@@ -0,0 +1,28 @@
+# bench_whisper_cpu.py (c) 2024 MissingNO123
+# Description: Measures how fast Whisper runs on this machine's CPU. For each model size it runs the same tuning as whisper_models.autotune_cpu on the bundled prebaked TTS clips and prints the real-time factor of every configuration, so you can tell which model size the machine can keep up with. Nothing is saved to the config.
+
+import argparse
+
+import options as opts
+import whisper_models
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=str, default=opts.whisper_model_size, help="Comma separated Whisper model sizes to try, e.g. tiny,base,small.")
+    parser.add_argument('--beams', type=int, default=opts.whisper_beams, help="Beam size to try first.")
+    parser.add_argument('--target', type=float, default=opts.whisper_rtf_target, help="Real-time factor that counts as fast enough.")
+    args = parser.parse_args()
+
+    opts.whisper_beams = args.beams
+    opts.whisper_rtf_target = args.target
+    summary = []
+    for model_size in [size.strip() for size in args.sizes.split(",") if size.strip()]:
+        results = whisper_models.autotune_cpu(model_size, persist=False)
+        for result in sorted(results, key=lambda result: result["rtf"]):
+            print(f'{model_size:<10} {result["compute_type"]:<8} {result["cpu_threads"]:>3} threads  beam {result["beam_size"]}  RTF {result["rtf"]:.3f}')
+        if len(results) > 0:
+            summary.append((model_size, min(result["rtf"] for result in results)))
+    print()
+    for model_size, rtf in summary:
+        print(f"{model_size:<10} best RTF {rtf:.3f}  {'keeps up' if rtf <= args.target else 'too slow'} (target {args.target})")
@@ -2,15 +2,30 @@
 # Description: This module contains functions to handle the main chat generation loop. It sends messages to an OpenAI API-compatible model and processes the streamed token responses. The module also contains functions to dynamically generate system prompts and call OpenAI functions. It is also able to return the raw completion object to be handled by other modules.
 
 import openai
-import time, sys
+import aiohttp
+import asyncio
+import json
+import requests
+from requests.adapters import HTTPAdapter
+import time, sys, re, os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
 from datetime import datetime
+from typing import List, Dict
+from urllib.parse import urlparse
 
 import vrcutils as vrc
 import options as opts
 import functions as funcs
 import embeddings as emb
+import metrics
+import streaming
 emb.load_memory_from_file()
 emb.load_knowledge_from_file()
+if opts.memory_watch_files:
+    emb.start_file_watcher()
 
 logit_bias = {
 #   'As',        'as',       ' an',      'AI',          ' AI',        ' language',  ' model',     'model',           
@@ -37,6 +52,298 @@ if len(opts.gpt_providers) > 0:
     providers["order"] = opts.gpt_providers
 
 
+class PersistentSession(requests.Session):
+    """ Session that's shared by every API call, so connections stay open between turns. openai 0.28 closes its session every few minutes, which would throw the open connections away, so close() does nothing here """
+    def close(self):
+        pass
+
+
+http_session = PersistentSession()
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+openai.requestssession = http_session
+
+prewarm_interval = 15 # seconds, don't bother opening the connection again if it was used this recently
+last_connection_time = 0
+prewarm_lock = threading.Lock()
+
+
+def prewarm_connection() -> None:
+    """ Opens the connection to the API in the background, so the TLS handshake is already done by the time the request is sent """
+    if not opts.prewarm_connection or time.time() - last_connection_time < prewarm_interval:
+        return
+    if not prewarm_lock.acquire(blocking=False): # already warming up
+        return
+    def target():
+        try:
+            start_time = time.perf_counter()
+            if opts.use_async_client:
+                async_client.prewarm()
+            else:
+                http_session.head(openai.api_base, timeout=5).close()
+            _mark_connection_used()
+            funcs.v_print(f"--Connection to {openai.api_base} warmed up in {time.perf_counter() - start_time:.3f}s")
+        except Exception as e:
+            funcs.v_print(f"Couldn't warm up connection: {e}")
+        finally:
+            prewarm_lock.release()
+    threading.Thread(target=target, name="prewarm-connection-thread", daemon=True).start()
+
+
+class AsyncChatClient:
+    """ Streams chat completions with aiohttp on an event loop thread of its own. Unlike a blocking ChatCompletion.create, a stream can be cancelled at any point,
+    even while still waiting for the first token, and cancelling closes the connection right away so the provider stops generating """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.session = None   # aiohttp.ClientSession, created on the loop thread
+        self.running = set()  # concurrent.futures.Future of every stream that's being read
+        self.last_backend = None # api_base the last stream came from, the winner if it was hedged
+        self.thread = threading.Thread(target=self.loop.run_forever, name="chat-client-loop-thread", daemon=True)
+        self.thread.start()
+
+    async def _get_session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout))
+        return self.session
+
+    def _headers(self, api_key: str | None) -> dict:
+        request_headers = {"Content-Type": "application/json", **headers}
+        if api_key:
+            request_headers["Authorization"] = f"Bearer {api_key}"
+        return request_headers
+
+    async def stream(self, request: dict, api_base: str | None = None, api_key: str | None = None):
+        """ Sends a chat completion request and yields each streamed chunk as a dict, in the same shape openai returns them. Goes to openai.api_base unless another backend is given """
+        session = await self._get_session()
+        api_base = api_base or openai.api_base
+        api_key = api_key if api_key is not None else openai.api_key
+        stats = backend_stats.setdefault(api_base, BackendStats())
+        stats.requests += 1
+        start_time = time.perf_counter()
+        got_token = False
+        async with session.post(f"{api_base.rstrip('/')}/chat/completions", json=request, headers=self._headers(api_key)) as response:
+            try:
+                if response.status != 200:
+                    raise openai.APIError(f"HTTP {response.status}: {(await response.text())[:500]}", http_status=response.status)
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == b"[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise openai.APIError(str(chunk["error"]))
+                    if not got_token and _has_token(chunk):
+                        got_token = True
+                        stats.add_ttft(time.perf_counter() - start_time)
+                    yield chunk
+            except (asyncio.CancelledError, GeneratorExit):
+                response.close() # drop the connection instead of returning it to the pool, the server sees the disconnect and stops generating
+                raise
+            except Exception:
+                stats.errors += 1
+                raise
+
+    async def hedged_stream(self, request: dict, secondary_request: dict, secondary_api_base: str, secondary_api_key: str | None):
+        """ Streams from the primary backend, and sends the same request to the secondary backend too if the primary hasn't produced a token within the hedge delay (or failed).
+        Whichever produces a token first wins and the other one is cancelled """
+        settled = asyncio.Event()
+        primary = _HedgeRacer(self.stream(request), openai.api_base, settled)
+        racers = [primary]
+        delay = hedge_delay()
+        try:
+            try:
+                await asyncio.wait_for(primary.first_token.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            if not primary.ready():
+                reason = f"failed ({primary.error})" if primary.error is not None else f"gave no token after {delay:.2f}s"
+                funcs.v_print(f"--{openai.api_base} {reason}, also asking {secondary_api_base}")
+                racers.append(_HedgeRacer(self.stream(secondary_request, secondary_api_base, secondary_api_key), secondary_api_base, settled))
+            while True:
+                settled.clear()
+                winner = min((racer for racer in racers if racer.ready()), key=lambda racer: racer.ready_time, default=None)
+                if winner is not None or all(racer.task.done() for racer in racers):
+                    break
+                await settled.wait()
+            for racer in racers:
+                if racer is not winner:
+                    racer.task.cancel()
+            if winner is not None and winner is not primary and not primary.ready() and primary.error is None:
+                # the primary lost without a first token, so its time to first token is at least this long. Leaving it out would drag the p90 (and with it the hedge delay) down
+                backend_stats[openai.api_base].add_ttft(winner.ready_time - primary.start_time)
+            if winner is None:
+                raise primary.error
+            self.last_backend = winner.api_base
+            if len(racers) > 1:
+                backend_stats[winner.api_base].wins += 1
+                funcs.v_print(f"--{'Primary' if winner is primary else 'Secondary'} backend won the hedge")
+            while True:
+                chunk = await winner.chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            if winner.error is not None:
+                raise winner.error
+        finally:
+            for racer in racers:
+                racer.task.cancel()
+
+    def stream_sync(self, request: dict, secondary: tuple | None = None):
+        """ Runs stream() on the client's loop and yields its chunks to a regular thread. Raises streaming.StreamCancelled if the stream gets cancelled.
+        secondary is (request, api_base, api_key) of a backend to hedge with """
+        chunks = Queue()
+        end = object()
+        cancelled = object()
+        self.last_backend = openai.api_base
+        async def pump():
+            try:
+                async for chunk in (self.stream(request) if secondary is None else self.hedged_stream(request, *secondary)):
+                    chunks.put(chunk)
+            except asyncio.CancelledError:
+                chunks.put(cancelled)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(end)
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        self.running.add(future)
+        future.add_done_callback(self.running.discard)
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is end:
+                    return
+                if chunk is cancelled:
+                    raise streaming.StreamCancelled()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            future.cancel() # the caller stopped reading, e.g. it broke out on a function call
+
+    def cancel(self) -> None:
+        """ Cancels every stream that's in progress """
+        for future in list(self.running):
+            future.cancel()
+
+    async def _prewarm(self) -> None:
+        session = await self._get_session()
+        async with session.head(openai.api_base, timeout=aiohttp.ClientTimeout(total=5)) as response:
+            await response.release()
+
+    def prewarm(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._prewarm(), self.loop).result()
+
+
+class _HedgeRacer:
+    """ Reads one backend's stream into a queue during a hedged request, so it can be raced against another backend and either one dropped """
+    def __init__(self, stream, api_base: str, settled: asyncio.Event):
+        self.stream = stream
+        self.api_base = api_base
+        self.settled = settled                 # shared by all racers, set whenever one of them gets its first token or ends
+        self.chunks = asyncio.Queue()          # chunks read so far, None once the stream ended
+        self.first_token = asyncio.Event()
+        self.start_time = time.perf_counter()
+        self.ready_time = None                 # when the first token arrived (or the stream ended without error)
+        self.error = None
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def ready(self) -> bool:
+        return self.ready_time is not None
+
+    async def _run(self) -> None:
+        try:
+            async for chunk in self.stream:
+                if not self.ready() and _has_token(chunk):
+                    self.ready_time = time.perf_counter()
+                    self.first_token.set()
+                    self.settled.set()
+                self.chunks.put_nowait(chunk)
+            if not self.ready():
+                self.ready_time = time.perf_counter()
+        except asyncio.CancelledError:
+            await self.stream.aclose()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.chunks.put_nowait(None)
+            self.first_token.set()
+            self.settled.set()
+
+
+def _has_token(chunk: dict) -> bool:
+    choices = chunk.get("choices") or []
+    if len(choices) == 0:
+        return False
+    delta = choices[0].get("delta") or {}
+    return bool(delta.get("content") or delta.get("function_call") or delta.get("tool_calls"))
+
+
+class BackendStats:
+    """ Recent time-to-first-token samples of a backend, used to pick the hedge delay """
+    def __init__(self, max_samples: int = 50):
+        self.ttfts = deque(maxlen=max_samples)
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0 # hedged requests this backend won
+
+    def add_ttft(self, seconds: float) -> None:
+        self.ttfts.append(seconds)
+
+    def percentile(self, p: float) -> float | None:
+        return metrics.percentile(self.ttfts, p)
+
+
+backend_stats = {} # api base url -> BackendStats
+hedge_min_samples = 10
+
+
+def hedge_delay() -> float:
+    """ How long to wait for the primary backend's first token before hedging. Once there are enough samples this is the primary's p90 time to first token,
+    so only its slowest requests get hedged, capped at opts.hedge_delay """
+    stats = backend_stats.get(openai.api_base)
+    if not opts.hedge_adaptive or stats is None or len(stats.ttfts) < hedge_min_samples:
+        return opts.hedge_delay
+    return max(0.05, min(opts.hedge_delay, stats.percentile(90)))
+
+
+def get_backend_stats() -> Dict[str, dict]:
+    """ Returns latency stats per backend, e.g. for printing """
+    return {api_base: {
+                "requests": stats.requests, "errors": stats.errors, "hedge_wins": stats.wins,
+                "ttft_p50": stats.percentile(50), "ttft_p90": stats.percentile(90), "ttft_p99": stats.percentile(99)
+            } for api_base, stats in backend_stats.items()}
+
+
+def _hedge_backend(request: dict) -> tuple | None:
+    """ Returns (request, api_base, api_key) for the secondary backend, or None if hedging is off """
+    if not (opts.hedge_enabled and opts.use_async_client and opts.hedge_api_url) or opts.hedge_api_url.rstrip('/') == openai.api_base.rstrip('/'):
+        return None
+    secondary_request = dict(request)
+    if opts.hedge_model_name:
+        secondary_request["model"] = opts.hedge_model_name
+    # the primary's key only goes to the same host, so a third party secondary never sees it
+    api_key = os.getenv('HEDGE_API_KEY') or (openai.api_key if urlparse(opts.hedge_api_url).hostname == urlparse(openai.api_base).hostname else "")
+    return (secondary_request, opts.hedge_api_url, api_key)
+
+
+async_client = AsyncChatClient()
+
+
+def cancel_generation() -> None:
+    """ Stops a generation that's in progress, closing its connection. Used by the panic key """
+    async_client.cancel()
+
+
+def _mark_connection_used() -> None:
+    global last_connection_time
+    last_connection_time = time.time()
+
+
 def update_base_url():
     if opts.gpt == "custom":
         openai.api_base = opts.custom_api_url
@@ -87,24 +394,26 @@ functions=[
         }
     }
 ]
+tools = [{"type": "function", "function": function} for function in functions]
+tool_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool-call")
+max_tool_rounds = 3
 
-def generate(text="", return_completion=False):
-    """ Sends text to OpenAI, gets the response, and returns it """
+def generate(text="", return_completion=False, speech=None, tool_round=0):
+    """ Sends text to OpenAI, gets the response, and returns it. If a funcs.SpeechStream is passed as speech, tokens are fed to it as they arrive.
+    If the model calls tools, they're run and the follow-up reply is returned instead, tool_round counts how many times that happened in a row """
+    global last_usage
     opts.generating = True
-    while len(opts.message_array) > opts.max_conv_length:  # Trim down chat buffer if it gets too long
-        opts.message_array.pop(0)
-    # Init system prompt with date and add it persistently to top of chat buffer
-    system_prompt_object = generate_system_prompt_object()
-    message_plus_system = system_prompt_object 
-    if not any(msg in opts.message_array[:len(opts.example_messages)] for msg in opts.example_messages):
-        message_plus_system += opts.example_messages # checks if any of the example messages are already in the message array
-    message_plus_system += opts.message_array
+    timer = metrics.RequestTimer()
+    trim_conversation()  # Trim down chat buffer if it gets too long
+    message_plus_system = build_messages()
+    timer.prompt_built(last_retrieval_time)
     err = None
+    consumer = streaming.StreamConsumer(on_usage=record_usage, timer=timer)
     gpt_snapshot = "gpt-3.5-turbo-0613" if opts.gpt == "GPT-3" else "gpt-4-0613" if opts.gpt == "GPT-4" else opts.custom_model_name if opts.gpt == "custom" else "gpt-3.5-turbo-0613"
     try:
         vrc.chatbox('🤔 Thinking...')
         start_time = time.perf_counter()
-        completion = openai.ChatCompletion.create(
+        request = dict(
             model=gpt_snapshot,
             messages=message_plus_system,
             max_tokens=opts.max_tokens,
@@ -114,40 +423,38 @@ def generate(text="", return_completion=False):
             top_p=opts.top_p,
             min_p=opts.min_p,
             top_k=opts.top_k,
-            timeout=timeout,
             stream=True,
-            headers=headers,
             provider=providers,
             # logit_bias=logit_bias,  # doesn't work for LLaMA
-            # tools=functions,    # eats tokens
-            # tool_choice="auto"
-            
             )
+        if opts.enable_tools and tool_round < max_tool_rounds: # past the limit the model has to answer with what it has
+            request["tools"] = tools # eats tokens
+            request["tool_choice"] = "auto"
+        if opts.prompt_cache_layout or opts.metrics_enabled:
+            request["stream_options"] = {"include_usage": True}
+        last_usage = {}
+        timer.request_sent()
+        if opts.use_async_client:
+            completion = async_client.stream_sync(request, _hedge_backend(request))
+        else:
+            completion = openai.ChatCompletion.create(**request, timeout=timeout, headers=headers)
         if return_completion:
-            return completion
-        completion_text = ''
-        is_function_call = False
-        function_args = {}
+            return _metered_stream(completion, timer, gpt_snapshot)
+        consumer.add_sink(streaming.ConsoleSink())
+        if speech is not None:
+            consumer.add_sink(streaming.SpeechSink(speech))
+        elif opts.chatbox:
+            consumer.add_sink(streaming.ChatboxSink())
         print("\n>AI: ", end='')
-        for chunk in completion:
-            if opts.panic:
-                break
-            event_text = ''
-            chunk_message = chunk['choices'][0]['delta']  # extract the message
-            if chunk_message.get('content'):
-                event_text = chunk_message['content']
-            print(event_text, end='')
-            sys.stdout.flush()
-            completion_text += event_text  # append the text
-            if chunk['choices'][0]['delta'].get('function_call'):
-                is_function_call = True
-                function_args = chunk['choices'][0]['delta']["function_call"]
-                break
+        completion_text = consumer.consume(completion)
+        tool_calls = consumer.tool_calls
         end_time = time.perf_counter()
-        if is_function_call:
+        _mark_connection_used()
+        _finish_metrics(timer, gpt_snapshot, consumer, consumer.status)
+        if len(tool_calls) > 0 and not opts.panic:
             funcs.v_print(f'--OpenAI Function call took {end_time - start_time:.3f}s')
-            print("[Running Function...]")
-            return call_function(function_args)
+            print(f"[Running {len(tool_calls)} Function(s)...]")
+            return run_tool_calls(tool_calls.result(), speech, tool_round + 1, funcs.clear_between_tags(completion_text).strip())
         print()
         funcs.v_print(f'--OpenAI API took {end_time - start_time:.3f}s')
         # result = completion.choices[0].message.content
@@ -178,10 +485,37 @@ def generate(text="", return_completion=False):
         opts.generating = False
         vrc.clear_prop_params()
         if err is not None: 
+            _finish_metrics(timer, gpt_snapshot, consumer, err)
             vrc.chatbox(f'⚠ Error: {err}')
             return None
 
 
+def _metered_stream(completion, timer: metrics.RequestTimer, model: str):
+    """ Passes a stream on to whoever reads it (the UI), ticking the timer as it goes and adding it to the metrics once it's read or dropped """
+    tracker = streaming.StreamConsumer(timer=timer) # no on_usage, the reader records the usage itself
+    try:
+        for chunk in completion:
+            tracker.feed(chunk)
+            yield chunk
+        _mark_connection_used()
+    except (GeneratorExit, streaming.StreamCancelled): # the reader stopped early
+        tracker.cancelled = True
+        raise
+    finally:
+        _finish_metrics(timer, model, tracker, tracker.status)
+
+
+def _finish_metrics(timer: metrics.RequestTimer, model: str, consumer: streaming.StreamConsumer, error: str | None) -> None:
+    """ Adds the timings of a generation to the metrics history, once """
+    if not opts.metrics_enabled or timer.finished:
+        return
+    provider = consumer.provider or (async_client.last_backend if opts.use_async_client else None) or openai.api_base
+    entry = timer.finish(model, provider, last_usage, len(consumer.tool_calls), error)
+    if entry["time_to_first_token"] is not None:
+        tokens_per_second = f'{entry["tokens_per_second"]:.1f} tok/s' if entry["tokens_per_second"] is not None else "n/a tok/s"
+        funcs.v_print(f'--Prompt built in {entry["prompt_build_time"]:.3f}s, first token after {entry["time_to_first_token"]:.3f}s, {tokens_per_second} from {provider}')
+
+
 # def get_completion(text):
 #     """ Sends text to OpenAI, gets the response, and returns the raw completion object """
 #     while len(opts.message_array) > opts.max_conv_length:  # Trim down chat buffer if it gets too long
@@ -220,81 +554,286 @@ def generate(text="", return_completion=False):
 
 
 def call_function(function_args):
-    """ Runs a function whenever CGPT suggests one to be called, then returns the result from CGPT """
-    function_name = function_args.get("name")
-    function_content = ""
-    
-    if function_name == "get_user_count":
-        function_content = str(funcs.get_player_count())
-
-    elif function_name == "get_user_list":
-        user_list = funcs.get_player_list()
-        function_content = ', '.join(['"{0}"'.format(item) for item in user_list])
-
-    elif function_name == "get_vrchat_player_count":
-        function_content = funcs.get_vrchat_player_count()
-        if function_content is None:
-            function_content = "An error occurred getting the player count."
-
-    function_call_message_object = {
-        "role": "assistant",
-        "content": "",
-        "tool_calls": [
-            function_args
-        ]
-    }
-    function_return_message_object = {
-        "role": "tool",
-        "name": function_name,
-        "content": function_content
-    }
-    opts.message_array.append(function_call_message_object)
-    opts.message_array.append(function_return_message_object)
+    """ Runs a single function call in the old function_call format, then returns the follow-up reply """
+    return run_tool_calls([{"id": "call_0", "type": "function", "function": {"name": function_args.get("name", ""), "arguments": function_args.get("arguments") or "{}"}}])
 
-    # Init system prompt with date and add it persistently to top of chat buffer
-    system_prompt_object = generate_system_prompt_object()
-    message_plus_system = system_prompt_object 
-    if not any(msg in opts.message_array[:len(opts.example_messages)] for msg in opts.example_messages):
-        message_plus_system += opts.example_messages # checks if any of the example messages are already in the message array
-    message_plus_system += opts.message_array
-    # err = None
-    gpt_snapshot = "gpt-3.5-turbo-0613" if opts.gpt == "GPT-3" else "gpt-4-0613" if opts.gpt == "GPT-4" else opts.custom_model_name if opts.gpt == "custom" else "gpt-3.5-turbo-0613"
+
+def run_tool_calls(tool_calls: List[dict], speech=None, tool_round: int = 1, content: str = ""):
+    """ Runs the tool calls the model asked for in parallel, adds the results to the conversation, then streams the model's follow-up reply through generate and returns it """
+    opts.message_array.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
+    start_time = time.perf_counter()
+    results = list(tool_executor.map(_run_tool_call, tool_calls))
+    funcs.v_print(f"--Ran {len(tool_calls)} tool call(s) in {time.perf_counter() - start_time:.3f}s")
+    for tool_call, result in zip(tool_calls, results):
+        opts.message_array.append({"role": "tool", "tool_call_id": tool_call["id"], "name": tool_call["function"]["name"], "content": result})
+    return generate(speech=speech, tool_round=tool_round)
+
+
+def _run_tool_call(tool_call: dict) -> str:
+    name = tool_call["function"]["name"]
+    function = tool_functions.get(name)
+    if function is None:
+        return f"Unknown function: {name}"
     try:
-        completion = openai.ChatCompletion.create(
-            model=gpt_snapshot,
-            messages=message_plus_system,
-            max_tokens=opts.max_tokens,
-            temperature=opts.temperature,
-            frequency_penalty=opts.frequency_penalty,
-            presence_penalty=opts.presence_penalty,
-            timeout=timeout,
-            logit_bias=logit_bias
-            )
-        result = completion["choices"][0]["message"]["content"]
-        funcs.append_bot_message(funcs.inverse_title_case(result))
-        print(result)
-        return result
+        arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+        return function(arguments)
     except Exception as e:
-        # err = e
-        print(f"!!Exception: {e}")
-        return None
-    
+        print(f"!!Exception running {name}: {e}")
+        return f"An error occurred running {name}."
+
+
+def _get_user_count(arguments: dict) -> str:
+    player_count = vrc.get_player_count()
+    return str(player_count) if player_count is not None else "VRChat is not running."
+
+
+def _get_user_list(arguments: dict) -> str:
+    player_list = vrc.get_player_list()
+    return ', '.join([f'"{item}"' for item in player_list]) if player_list is not None else "VRChat is not running."
+
+
+def _get_vrchat_player_count(arguments: dict) -> str:
+    player_count = vrc.get_vrchat_player_count()
+    return str(player_count) if player_count is not None else "An error occurred getting the player count."
+
+
+tool_functions = {
+    "get_user_count": _get_user_count,
+    "get_user_list": _get_user_list,
+    "get_vrchat_player_count": _get_vrchat_player_count,
+}
+
+
+# Token counts are estimated at about 4 characters per token, which is close enough to keep the prompt size predictable without loading a tokenizer for every model
+image_token_cost = 765   # roughly what OpenAI charges for a 1024x1024 image, the length of the base64 data says nothing about this
+message_token_overhead = 4
+summary_max_chars = 800  # ~200 tokens
+token_counts = {}        # id(message) -> (message content, estimated tokens), so messages aren't measured again every turn
+
+
+def count_tokens(message: dict) -> int:
+    """ Returns the estimated number of tokens a message takes up in the prompt """
+    content = message.get("content") or ""
+    cached = token_counts.get(id(message))
+    if cached is not None and cached[0] is content:
+        return cached[1]
+    if type(content) == list:
+        tokens = sum(image_token_cost if part.get("type") == "image_url" else len(part.get("text", "")) // 4 for part in content)
+    else:
+        tokens = len(content) // 4
+    if message.get("tool_calls"):
+        tokens += len(str(message["tool_calls"])) // 4
+    tokens += message_token_overhead
+    token_counts[id(message)] = (content, tokens)
+    return tokens
+
+
+def trim_conversation() -> None:
+    """ Drops the oldest messages until the conversation buffer fits in opts.max_context_tokens and opts.max_conv_length. The newest message is always kept """
+    total_tokens = sum(count_tokens(message) for message in opts.message_array)
+    evicted = []
+    while len(opts.message_array) > 1 and (len(opts.message_array) > opts.max_conv_length or (opts.max_context_tokens > 0 and total_tokens > opts.max_context_tokens)):
+        message = opts.message_array.pop(0)
+        total_tokens -= count_tokens(message)
+        evicted.append(message)
+    # a tool result can't be sent without the call it answers
+    while len(opts.message_array) > 1 and opts.message_array[0].get("role") == "tool":
+        evicted.append(opts.message_array.pop(0))
+    if len(evicted) == 0:
+        return
+    live_ids = {id(message) for message in opts.message_array}
+    for message_id in [message_id for message_id in token_counts if message_id not in live_ids]:
+        del token_counts[message_id]
+    funcs.v_print(f"Dropped {len(evicted)} old messages, conversation is now ~{total_tokens} tokens")
+    if opts.summarize_evicted:
+        _summarize_evicted(evicted)
+
+
+def _summarize_evicted(evicted: List[dict]) -> None:
+    """ Adds the first sentence of each dropped message to opts.conversation_summary, keeping only the most recent summary_max_chars of it """
+    lines = []
+    for message in evicted:
+        if message in opts.example_messages or message.get("role") not in ("user", "assistant"):
+            continue
+        text = _message_text(message).strip()
+        if len(text) == 0:
+            continue
+        first_sentence = re.split(r'(?<=[.!?])\s', text, maxsplit=1)[0][:200]
+        lines.append(f'{"User" if message["role"] == "user" else "You"}: {first_sentence}')
+    if len(lines) == 0:
+        return
+    summary = (opts.conversation_summary + " " + " ".join(lines)).strip()
+    if len(summary) > summary_max_chars:
+        summary = summary[-summary_max_chars:]
+        summary = summary[summary.find(" ") + 1:] # don't start in the middle of a word
+    opts.conversation_summary = summary
+
+
+def _message_text(message) -> str:
+    content = message["content"]
+    if type(content) == list:
+        content = content[0].get("text", "")
+    return content
+
+
+def retrieval_query(pending_text: str | None = None) -> str:
+    """ Returns the text memory and knowledge get searched with, which is the last two messages in the conversation.
+    If pending_text is given, it's treated as a user message that's about to be added """
+    if pending_text is None:
+        last_message = _message_text(opts.message_array[-1]) if len(opts.message_array) > 0 else ""
+        second_last_message = _message_text(opts.message_array[-2]) if len(opts.message_array) > 1 else ""
+    else:
+        last_message = funcs.replace_bad_words(pending_text, funcs.regexes["input"])
+        second_last_message = _message_text(opts.message_array[-1]) if len(opts.message_array) > 0 else ""
+    return second_last_message + " " + last_message
+
+
+class RetrievalPrefetcher:
+    """ Runs memory and knowledge searches on a background thread ahead of time, so the results are ready by the time the prompt gets built.
+    Only the newest submitted query is worth running, so a query that's still waiting when a newer one comes in is dropped """
+    def __init__(self, max_results: int = 8):
+        self.max_results = max_results
+        self.results = OrderedDict() # query -> Future of ((memory_version, search settings), knowledge_automaton, memory results, knowledge results)
+        self.pending = None          # (query, Future) waiting for the worker
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="retrieval-prefetch-thread", daemon=True)
+        self.thread.start()
+
+    def submit(self, query: str) -> None:
+        with self.lock:
+            if query in self.results and not self.results[query].cancelled():
+                return
+            if self.pending is not None:
+                self.pending[1].cancel()
+                self.results.pop(self.pending[0], None)
+            future = Future()
+            self.results[query] = future
+            while len(self.results) > self.max_results:
+                self.results.popitem(last=False)[1].cancel()
+            self.pending = (query, future)
+        self.wake.set()
+
+    def get(self, query: str, timeout: float = 1.0) -> tuple[List[str], List[str] | None] | None:
+        """ Returns the prefetched (memory results, knowledge results) for query, waiting for it if it's being worked on.
+        Returns None if the query wasn't prefetched or memory, knowledge or the search settings changed since """
+        with self.lock:
+            future = self.results.get(query)
+        if future is None:
+            return None
+        try:
+            version, automaton, memory_results, knowledge_results = future.result(timeout)
+        except Exception:
+            return None
+        if version != (emb.memory_version, emb.search_settings()) or automaton is not emb.knowledge_automaton:
+            return None
+        return (memory_results, knowledge_results)
+
+    def _run(self) -> None:
+        while True:
+            self.wake.wait()
+            with self.lock:
+                self.wake.clear()
+                pending, self.pending = self.pending, None
+            if pending is None or not pending[1].set_running_or_notify_cancel():
+                continue
+            query, future = pending
+            try:
+                version, automaton = (emb.memory_version, emb.search_settings()), emb.knowledge_automaton
+                future.set_result((version, automaton, emb.search_memory(query), emb.search_knowledge(query)))
+            except Exception as e:
+                future.set_exception(e)
+
+
+retrieval_prefetcher = RetrievalPrefetcher()
+
+
+def prefetch_retrieval(pending_text: str) -> None:
+    """ Starts looking up memory and knowledge for a user message that's still being spoken or is about to be queued """
+    if not opts.speculative_retrieval or len(pending_text.strip()) == 0:
+        return
+    retrieval_prefetcher.submit(retrieval_query(pending_text.strip()))
+
+
 prev_semantic_results = ""
+last_retrieval_time = None # Seconds the memory and knowledge search took for the last prompt, 0 if it was prefetched
+def build_messages() -> list:
+    """ Assembles the system prompt, example messages and conversation into the list of messages sent to the model.
+    With opts.prompt_cache_layout, the persona and examples are a prefix that stays the same from turn to turn, and everything that changes every turn goes at the end
+    (see opts.prompt_context_role), so the provider (or llama.cpp) can reuse its cache of the prefix """
+    if opts.prompt_cache_layout:
+        messages = [{"role": "system", "content": static_system_prompt()}]
+    else:
+        # Init system prompt with date and add it persistently to top of chat buffer
+        messages = generate_system_prompt_object()
+    if not any(msg in opts.message_array[:len(opts.example_messages)] for msg in opts.example_messages):
+        messages += opts.example_messages # checks if any of the example messages are already in the message array
+    messages += opts.message_array
+    if opts.prompt_cache_layout:
+        context = f"Context for your next reply: {generate_system_context().strip()}"
+        last_user = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+        if opts.prompt_context_role == "system" or last_user is None:
+            messages.append({"role": "system", "content": context})
+        else:
+            # copied, so the context doesn't stick to the message in the conversation buffer
+            message = dict(messages[last_user])
+            if isinstance(message["content"], list): # message with images
+                message["content"] = [{"type": "text", "text": context}] + message["content"]
+            else:
+                message["content"] = f"{context}\n\n{message['content']}"
+            messages[last_user] = message
+    return messages
+
+
+last_usage = {} # Token usage of the last completion, including how much of the prompt was read from the provider's prefix cache
+
+
+def record_usage(chunk) -> None:
+    """ Reads token usage from a completion or the final streamed chunk and logs how much of the prompt was cached.
+    Understands OpenAI style usage.prompt_tokens_details.cached_tokens and llama.cpp style timings """
+    global last_usage
+    usage = chunk.get("usage")
+    timings = chunk.get("timings")
+    if usage:
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        completion_tokens = usage.get("completion_tokens") or 0
+    elif timings:
+        cached_tokens = timings.get("cache_n") or 0
+        prompt_tokens = (timings.get("prompt_n") or 0) + cached_tokens
+        completion_tokens = timings.get("predicted_n") or 0
+    else:
+        return
+    last_usage = {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": completion_tokens}
+    cached_percent = 100 * cached_tokens / prompt_tokens if prompt_tokens > 0 else 0
+    funcs.v_print(f"--Prompt {prompt_tokens} tokens, {cached_tokens} cached ({cached_percent:.0f}%), completion {completion_tokens} tokens")
+
+
+def static_system_prompt() -> str:
+    """ The persona part of the system prompt, which only changes when the settings do """
+    bot_personality = opts.bot_personality.format(bot_name=opts.bot_name)
+    return opts.system_prompt.format(bot_name=opts.bot_name, bot_personality=bot_personality)
+
+
 def generate_system_prompt_object():
     # create object with system prompt and other realtime info
-    bot_personality = opts.bot_personality.format(bot_name=opts.bot_name)
-    system_prompt = opts.system_prompt.format(bot_name=opts.bot_name, bot_personality=bot_personality)
-    last_message = opts.message_array[-1]["content"] if len(opts.message_array) > 0 else ""
-    second_last_message = opts.message_array[-2]["content"] if len(opts.message_array) > 1 else ""
-    if type(last_message) == list:
-        last_message = last_message[0].get("content", "")
-    if type(second_last_message) == list:
-        second_last_message = second_last_message[0].get("content", "")
-    last_two_messages = second_last_message + " " + last_message
-
-    global prev_semantic_results
-    # attempt to look up relevant details from memory
-    semantic_results = emb.search_memory(last_two_messages)
+    return [{"role": "system", "content": static_system_prompt() + generate_system_context()}]
+
+
+def generate_system_context() -> str:
+    """ The part of the system prompt that changes every turn: memory and knowledge results, date and time, and VRChat world info """
+    last_two_messages = retrieval_query()
+
+    global prev_semantic_results, last_retrieval_time
+    # attempt to look up relevant details from memory, most of the time this was already done while the user was speaking
+    start_time = time.perf_counter()
+    prefetched = retrieval_prefetcher.get(last_two_messages) if opts.speculative_retrieval else None
+    if prefetched is not None:
+        semantic_results, knowledge_results = prefetched
+    else:
+        semantic_results = emb.search_memory(last_two_messages)
+        knowledge_results = emb.search_knowledge(last_two_messages)
+    last_retrieval_time = time.perf_counter() - start_time
     semantic_results = " ".join(semantic_results)
 
     # persist memory results for at least one extra generation 
@@ -314,8 +853,10 @@ def generate_system_prompt_object():
             funcs.v_print(f"Memory results: {semantic_results} {prev_semantic_results}")
     prev_semantic_results = semantic_results
 
+    if opts.summarize_evicted and opts.conversation_summary != "":
+        content += f'\n\nEarlier in the conversation: {opts.conversation_summary}'
+
     # Do a search through the last message to see if there are any keywords matching in the knowledge base
-    knowledge_results = emb.search_knowledge(last_two_messages)
     if knowledge_results != None:
         knowledge_results = " ".join(knowledge_results)
         if knowledge_results != "":
@@ -342,11 +883,7 @@ def generate_system_prompt_object():
         content += " VRChat is not running: no world or player information available."
     
     content += "\n\n"
-
-    system_prompt = [{"role": "system", "content":
-           system_prompt
-           + content}]
-    return system_prompt
+    return content
 
 if __name__ == "__main__":
     print("You ran the wrong file")
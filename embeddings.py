@@ -1,47 +1,330 @@
 # embeddings.py (c) 2024 MissingNO123
-# Description: This module handles vector embeddings for the bot's memory system. It uses the SentenceTransformers library to encode text data into vectors, which are then used to find similar data in the memory. The memory is a list of dictionaries, each containing a text data field and its corresponding vector embedding. The data returned from semantic search is used by the chat module to dynamically inject the results from memory search into the system prompt at generation time.
+# Description: This module handles vector embeddings for the bot's memory system. It uses the SentenceTransformers library to encode text data into vectors, which are then used to find similar data in the memory. The memory is a list of strings, kept alongside a single contiguous matrix of their L2-normalized vector embeddings so a search is just one matrix multiplication. The data returned from semantic search is used by the chat module to dynamically inject the results from memory search into the system prompt at generation time.
 import shutil
+import hashlib
+import re
+import numpy as np
+import torch
 import torch.nn.functional as F
 from torch import cuda
-from sentence_transformers import SentenceTransformer
-from sentence_transformers.util import semantic_search
 
 import time
 import os
 import json
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
 from typing import List, Dict
 
 import options as opts
 import functions as funcs
 
 print("hi mom")
-matryoshka_dim = 512
 top_k = 6
-# model = SentenceTransformer("nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True)
-model = SentenceTransformer(opts.sentence_transformer_model)
-if cuda.is_available():
-    model.to("cuda")
+model = None
 
-memory =  []
+def _load_model():
+    """ Imports and loads the SentenceTransformer model, then runs a warm-up encode so the first real query isn't a cold start """
+    global model
+    start_time = time.time()
+    from sentence_transformers import SentenceTransformer # importing this alone takes seconds, so it happens here on the loader thread
+    # loaded_model = SentenceTransformer("nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True)
+    loaded_model = SentenceTransformer(opts.sentence_transformer_model)
+    if cuda.is_available():
+        loaded_model.to("cuda")
+    loaded_model.encode("Hello, I am playing VRChat.", convert_to_tensor=True, precision="float32", device="cuda" if cuda.is_available() else "cpu")
+    model = loaded_model
+    end_time = time.time()
+    funcs.v_print(f"Sentence transformer loaded and warmed up in {end_time - start_time:0.3f} seconds.")
+    return loaded_model
+
+# The model loads on a background thread so importing this module doesn't hold up the UI, OSC server and audio setup.
+# The loader is single threaded, so anything submitted to it after the model (e.g. deferred memory loads) runs once the model is ready.
+_loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings-loader")
+model_ready = _loader.submit(_load_model) # Future that resolves to the model once it's loaded and warmed up
+_deferred_memory_load = None
+
+memory = []              # List of memory strings, row i of memory_embeddings is the embedding of memory[i]
+memory_embeddings = None # Contiguous (capacity x dim) matrix of L2-normalized embeddings, only the first len(memory) rows are valid. Holds int8 codes instead of floats if opts.memory_storage is "int8"
+memory_scales = None     # Per-row float scales of the int8 codes in memory_embeddings, None when storing floats
+_int_mm_supported = hasattr(torch, "_int_mm") # int8 x int8 -> int32 matmul, turned off the first time it fails on this device
 history = []
 knowledge = {}
+knowledge_automaton = None # KeywordAutomaton compiled from the keywords and aliases in knowledge, rebuilt whenever knowledge is loaded
+knowledge_descriptions = [] # Descriptions of the knowledge entries, indexed by the ids stored in knowledge_automaton
+memory_version = 0 # Bumped every time memory changes, so cached search results from an older memory are never returned
+memory_lock = threading.RLock() # Guards memory, memory_embeddings, memory_scales and memory_index, so a search never sees a half-published batch
+memory_index = None # IVFIndex over memory_embeddings, only used when opts.memory_index is "ivf"
+memory_index_builder = None # Thread building the next memory_index, searches stay exact until it's done
+ivf_min_items = 4096 # Below this many items brute force search is already fast enough, so no index is built
+
+# LRU caches for search_memory, the same text gets searched several times per turn (function calls, retries, re-polls of an unchanged buffer)
+query_cache_size = 128
+query_embedding_cache = OrderedDict() # query -> normalized query embedding
+query_result_cache = OrderedDict()    # (query, similarity threshold, memory_version, search settings) -> search results
+query_cache_stats = {"embedding_hits": 0, "embedding_misses": 0, "result_hits": 0, "result_misses": 0}
+query_cache_lock = threading.Lock()
+
+# Embeddings of memory items are cached on disk per model, so unchanged items don't have to go through the model again on every load
+embedding_cache_dir = os.path.join(os.path.dirname(__file__), "embedding_cache")
+embedding_cache_max_segments = 16 # Reloads add newly encoded items to the cache as small extra files, once there are this many they're merged back into one
+rescore_source = None # (cache index path, content hash -> (segment, row), segments) of the embedding cache, where int8 search results get their float rows from. Dropped whenever the cache is rewritten
+
+memory_file = os.path.join(os.path.dirname(__file__), "memory.json")
+# Items added at runtime with persist=True are appended here first and merged into memory.json in the background
+memory_journal_file = os.path.join(os.path.dirname(__file__), "memory.journal.jsonl")
+memory_file_lock = threading.Lock()
+memory_reload_lock = threading.Lock() # Only one reload at a time, so two reloads never reuse each other's row numbers
+memory_file_watcher = None # FileWatcher that reloads memory.json and knowledge.json when they're edited, only running when opts.memory_watch_files is on
 
 # There are two sources of info provided here - Memory and Knowlege. Memory when stored on disk is a list of strings, and when imported is turned into vector embeddings that represent their semantic meaning. Knowledge is a dictionary of keywords and their corresponding descriptions. Memory is meant to be a more "organic" way of recalling data that can match to tangentially related topics in conversation, whereas Knowlege is a much simpler system relating names to descriptions similar to a traditional dictionary or glossary. The data returned from either of these sources is used by the chat module to dynamically inject the results into the system prompt at generation time.
 
 def search_memory(query, similarity_threshold=opts.similarity_threshold) -> List[str]:
-    query_embedding = _get_embedding(query)
-    results = _get_similarity(query_embedding, memory)
-    filtered_results = []
-    for i, result in enumerate(results[0]):
-        if isinstance(result, dict) and 'corpus_id' in result:
-            # print(f"> {i+1}. [{result['score']:0.4f}] {memory[result['corpus_id']]['data']}")
-            if result['score'] > similarity_threshold:
-                filtered_results.append(memory[result['corpus_id']]['data'])
-        else:
-            print(f"Unexpected result format at index {i}: {result}")
+    if len(memory) == 0:
+        return []
+    if not is_model_ready():
+        # only knowledge search is available until the model has loaded
+        funcs.v_print("Sentence transformer not ready yet, skipping memory search.")
+        return []
+    cached_results = _query_cache_get(query_result_cache, (query, similarity_threshold, memory_version, search_settings()), "result")
+    if cached_results is not None:
+        return list(cached_results)
+    query_embedding = _query_cache_get(query_embedding_cache, query, "embedding")
+    if query_embedding is None:
+        query_embedding = F.normalize(_get_embedding(query).reshape(-1).float(), p=2, dim=0)
+        _query_cache_put(query_embedding_cache, query, query_embedding)
+    with memory_lock:
+        if len(memory) == 0:
+            return []
+        result_key = (query, similarity_threshold, memory_version, search_settings())
+        top_scores, top_indices = _search_embeddings(query_embedding, top_k)
+        filtered_results = []
+        for score, index in zip(top_scores, top_indices):
+            # print(f"> [{score:0.4f}] {memory[index]}")
+            if score > similarity_threshold:
+                filtered_results.append(memory[index])
+    _query_cache_put(query_result_cache, result_key, tuple(filtered_results))
     return filtered_results
 
 
+def search_settings() -> tuple:
+    """ The options that change what a search returns for the same memory, part of the result cache key so changing one at runtime doesn't return stale results """
+    return (top_k, opts.memory_index, opts.memory_index_probes, opts.memory_storage, opts.memory_rescore, opts.memory_rescore_multiplier, opts.memory_matryoshka_dim)
+
+
+def _search_embeddings(query_embedding, k: int, exact: bool = False) -> tuple[List[float], List[int]]:
+    """ Returns the scores and memory indices of the k rows most similar to a normalized query embedding, using the ANN index if one is enabled """
+    count = len(memory)
+    query_embedding = _prepare_embeddings(query_embedding.reshape(1, -1))[0]
+    index = None if exact else _get_memory_index()
+    rows = index.candidates(query_embedding, opts.memory_index_probes) if index is not None else None
+    if rows is not None and len(rows) == 0:
+        rows = None
+    candidate_count = count if rows is None else len(rows)
+    if memory_scales is None:
+        if rows is None:
+            scores = memory_embeddings[:count] @ query_embedding # both sides are normalized, so this is cosine similarity
+        else:
+            scores = torch.index_select(memory_embeddings, 0, rows) @ query_embedding
+        top_scores, top_positions = torch.topk(scores, k=min(k, candidate_count))
+    else:
+        # int8 scores are approximate, so over-fetch and rescore the shortlist against the original float rows
+        shortlist = k * opts.memory_rescore_multiplier if opts.memory_rescore else k
+        codes = memory_embeddings[:count] if rows is None else torch.index_select(memory_embeddings, 0, rows)
+        scales = memory_scales[:count] if rows is None else torch.index_select(memory_scales, 0, rows)
+        scores = _int8_scores(codes, scales, query_embedding)
+        top_scores, top_positions = torch.topk(scores, k=min(shortlist, candidate_count))
+        if opts.memory_rescore:
+            shortlist_indices = top_positions if rows is None else rows[top_positions]
+            rescored = _original_rows(shortlist_indices.tolist(), query_embedding.device) @ query_embedding
+            top_scores, order = torch.topk(rescored, k=min(k, len(rescored)))
+            top_positions = top_positions[order]
+    top_indices = top_positions if rows is None else rows[top_positions]
+    return (top_scores.tolist(), top_indices.tolist())
+
+
+def _original_rows(indices: List[int], device):
+    """ Returns the float embeddings of memory rows as they were before int8 quantization, read from the embedding cache and truncated and normalized like the stored ones.
+    Items that aren't in the cache (added at runtime) fall back to their dequantized rows """
+    global rescore_source
+    if rescore_source is None or rescore_source[0] != _embedding_cache_index_path():
+        segments = _read_embedding_cache()
+        cached_rows = {}
+        for segment, (segment_keys, _) in enumerate(segments):
+            for row, key in enumerate(segment_keys):
+                cached_rows[key] = (segment, row)
+        rescore_source = (_embedding_cache_index_path(), cached_rows, segments)
+    _, cached_rows, segments = rescore_source
+    original = _memory_rows(torch.tensor(indices, dtype=torch.long, device=memory_embeddings.device)).float().to(device)
+    found = [(position, cached_rows[key]) for position, key in enumerate(_content_hash(memory[index]) for index in indices) if key in cached_rows]
+    if len(found) > 0:
+        cached = np.stack([segments[segment][1][row] for _, (segment, row) in found])
+        original[[position for position, _ in found]] = _prepare_embeddings(torch.from_numpy(cached).to(device))
+    return original
+
+
+def _int8_scores(codes, scales, query_embedding):
+    """ Approximate dot products of a float query against int8 rows, quantizing the query too so the heavy part runs as an integer matmul """
+    global _int_mm_supported
+    query_scale = query_embedding.abs().max().clamp(min=1e-12) / 127
+    query_codes = torch.round(query_embedding / query_scale).to(torch.int8)
+    if _int_mm_supported:
+        try:
+            # _int_mm wants a matrix on the right, so the query is repeated into 8 identical columns
+            dots = torch._int_mm(codes, query_codes.unsqueeze(1).repeat(1, 8).contiguous())[:, 0]
+            return dots.float() * scales * query_scale
+        except RuntimeError:
+            _int_mm_supported = False
+    dots = torch.cat([codes[i:i + 16384].float() @ query_codes.float() for i in range(0, codes.shape[0], 16384)])
+    return dots * scales * query_scale
+
+
+def _get_memory_index():
+    """ Returns the ANN index to search memory with, or None for exact search. If the index is enabled but missing or has gone stale a new one is built in the background,
+    and searches are exact (or keep using the old index while it still covers memory) until it's ready. Caller must hold memory_lock """
+    global memory_index
+    count = len(memory)
+    if opts.memory_index != "ivf" or count < ivf_min_items:
+        memory_index = None
+        return None
+    if memory_index is not None and memory_index.size() == count:
+        if count > memory_index.built_size * 4: # the clusters were trained on a much smaller memory
+            _rebuild_memory_index()
+        return memory_index
+    _rebuild_memory_index()
+    return None
+
+
+def _rebuild_memory_index(wait: bool = False) -> None:
+    """ Starts building a new index over memory on a background thread, unless one is already being built. k-means over a big memory takes seconds, which would otherwise hold up a search.
+    Caller must hold memory_lock, except with wait, which waits for the index to be ready """
+    global memory_index, memory_index_builder
+    if opts.memory_index != "ivf" or len(memory) < ivf_min_items:
+        memory_index = None
+        return
+    if memory_index_builder is None or not memory_index_builder.is_alive():
+        # the first len(memory) rows of the storage never change once published (reloads and format changes make new storage), so the builder can read them without the lock
+        memory_index_builder = threading.Thread(target=_build_memory_index, args=(memory_embeddings, memory_scales, len(memory)), name="memory-index-thread", daemon=True)
+        memory_index_builder.start()
+    if wait:
+        memory_index_builder.join()
+
+
+def _build_memory_index(store, scales, count: int) -> None:
+    global memory_index
+    start_time = time.time()
+    def get_rows(rows):
+        return store[rows] if scales is None else store[rows].float() * scales[rows].unsqueeze(1)
+    try:
+        index = IVFIndex(count, get_rows)
+    except Exception as e:
+        print(f"Error building memory index: {e}")
+        return
+    with memory_lock:
+        if memory_embeddings is not store or opts.memory_index != "ivf":
+            return # memory was reloaded while building, the next search starts over
+        if len(memory) > count: # items appended while building
+            index.add(_memory_rows(slice(count, len(memory))))
+        memory_index = index
+    end_time = time.time()
+    funcs.v_print(f"Built memory index with {index.list_count} lists over {count} items in {end_time - start_time:0.3f} seconds.")
+
+
+class IVFIndex:
+    """ Inverted file index for approximate nearest neighbour search. Memory rows are clustered around centroids with spherical k-means, and a query only scores the rows in the few clusters closest to it """
+    def __init__(self, count: int, get_rows, list_count: int | None = None, iterations: int = 10, seed: int = 0):
+        """ get_rows takes a slice or tensor of row indices and returns those rows as normalized float embeddings """
+        self.built_size = count
+        self.list_count = list_count or max(1, min(count, int(math.sqrt(count))))
+        generator = torch.Generator().manual_seed(seed)
+        # training on a sample is plenty for k-means and keeps build time flat for huge stores
+        sample = get_rows(torch.sort(torch.randperm(count, generator=generator)[:self.list_count * 256]).values)
+        centroids = sample[torch.randperm(sample.shape[0], generator=generator)[:self.list_count].to(sample.device)].clone()
+        for _ in range(iterations):
+            sample_assignments = torch.argmax(sample @ centroids.T, dim=1)
+            sums = torch.zeros_like(centroids).index_add_(0, sample_assignments, sample)
+            empty = torch.bincount(sample_assignments, minlength=self.list_count) == 0
+            if empty.any():
+                # reseed clusters that lost all their points so no list ends up permanently empty
+                reseed = torch.randint(0, sample.shape[0], (int(empty.sum()),), generator=generator).to(sample.device)
+                sums[empty] = sample[reseed]
+            centroids = F.normalize(sums, p=2, dim=1)
+        self.centroids = centroids
+        # assign in chunks so neither the dequantized rows nor the (rows x lists) score matrix get big
+        assignments = [self._assign(get_rows(slice(i, min(i + 16384, count)))) for i in range(0, count, 16384)]
+        self.assignments = torch.cat(assignments) if assignments else torch.empty(0, dtype=torch.long, device=centroids.device)
+        self._sort_lists()
+
+    def _assign(self, embeddings):
+        """ Returns the id of the nearest centroid for each row """
+        return torch.argmax(embeddings @ self.centroids.T, dim=1)
+
+    def _sort_lists(self) -> None:
+        """ Groups row ids by list, so the rows of list l are list_rows[list_offsets[l]:list_offsets[l + 1]] """
+        self.list_rows = torch.argsort(self.assignments, stable=True)
+        self.list_offsets = [0] + torch.cumsum(torch.bincount(self.assignments, minlength=self.list_count), dim=0).tolist()
+        self.lists_dirty = False
+
+    def add(self, embeddings) -> None:
+        """ Assigns newly appended memory rows to their lists, rows must be added in the same order as memory """
+        self.assignments = torch.cat([self.assignments, self._assign(embeddings)])
+        self.lists_dirty = True # re-sorted lazily, so adding items one at a time doesn't sort once per item
+
+    def remap(self, count: int, kept_positions, kept_rows, new_positions, new_embeddings) -> None:
+        """ Follows a reload of memory: rows that were kept move from kept_rows to kept_positions with the list they were already in, and the new rows are assigned to their lists. Saves re-running k-means for every edit """
+        assignments = torch.empty(count, dtype=torch.long, device=self.assignments.device)
+        assignments[kept_positions] = self.assignments.index_select(0, kept_rows)
+        if new_embeddings is not None:
+            assignments[new_positions] = self._assign(new_embeddings)
+        self.assignments = assignments
+        self.lists_dirty = True
+
+    def size(self) -> int:
+        return self.assignments.shape[0]
+
+    def candidates(self, query_embedding, probes: int):
+        """ Returns the memory row indices in the lists whose centroids are closest to the query """
+        if self.lists_dirty:
+            self._sort_lists()
+        probed_lists = torch.topk(self.centroids @ query_embedding, k=min(probes, self.list_count)).indices.tolist()
+        return torch.cat([self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probed_lists])
+
+
+def get_query_cache_stats() -> Dict[str, int]:
+    """ Returns the hit and miss counters of the search_memory caches """
+    with query_cache_lock:
+        return query_cache_stats.copy()
+
+
+def _query_cache_get(cache: OrderedDict, key, kind: str):
+    with query_cache_lock:
+        value = cache.get(key)
+        if value is None:
+            query_cache_stats[f"{kind}_misses"] += 1
+            return None
+        cache.move_to_end(key)
+        query_cache_stats[f"{kind}_hits"] += 1
+        return value
+
+
+def _query_cache_put(cache: OrderedDict, key, value) -> None:
+    with query_cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > query_cache_size:
+            cache.popitem(last=False)
+
+
+def _memory_changed() -> None:
+    """ Invalidates cached search results, call after anything that modifies memory """
+    global memory_version
+    memory_version += 1
+    with query_cache_lock:
+        query_result_cache.clear()
+
+
 # def search_knowledge(message: str) -> List[str] | None:
 #     results = []
 #     for keyword in knowledge.keys():
@@ -50,68 +333,387 @@ def search_memory(query, similarity_threshold=opts.similarity_threshold) -> List
 #     return results if results else None
 
 def search_knowledge(message: str) -> List[str] | None:
-    results = []
+    if knowledge_automaton is None:
+        return None
     start_time = time.time()
-    for keyword, value in knowledge.items():
-        if isinstance(value, dict):
-            description = value.get("description", "")
-            aliases = value.get("aliases", [])
-            if keyword.lower() in message.lower() or any(alias.lower() in message.lower() for alias in aliases):
-                results.append(description)
-        else:
-            if keyword.lower() in message.lower():
-                results.append(value)
+    matched_ids = knowledge_automaton.search(message.lower())
+    results = [knowledge_descriptions[i] for i in sorted(matched_ids)]
     end_time = time.time()
     funcs.v_print(f"Knowledge search completed in {end_time - start_time:0.3f} seconds.")
     return results if results else None
 
 
+class KeywordAutomaton:
+    """ Aho-Corasick automaton that finds every keyword occurring in a text in a single pass over it. Keywords only match on word boundaries, so "pug" won't match inside "pugnacious" """
+    def __init__(self):
+        self.transitions = [{}]  # state -> {character: next state}
+        self.fail = [0]          # state -> longest proper suffix state that is also a prefix of some keyword
+        self.outputs = [[]]      # state -> [(keyword length, id)] of every keyword ending at this state
+
+    def add(self, keyword: str, id: int) -> None:
+        if len(keyword) == 0:
+            return
+        state = 0
+        for char in keyword:
+            next_state = self.transitions[state].get(char)
+            if next_state is None:
+                next_state = len(self.transitions)
+                self.transitions[state][char] = next_state
+                self.transitions.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        self.outputs[state].append((len(keyword), id))
+
+    def build(self) -> None:
+        """ Computes failure links breadth first, must be called after all keywords are added """
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for char, next_state in self.transitions[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.transitions[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+                queue.append(next_state)
+
+    def search(self, text: str) -> set:
+        """ Returns the ids of every keyword found in text, text should already be lowercased """
+        found = set()
+        state = 0
+        length = len(text)
+        for i, char in enumerate(text):
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(char, 0)
+            for keyword_length, id in self.outputs[state]:
+                start = i - keyword_length + 1
+                # a keyword edge that is a word character must not be glued to another word character
+                if start > 0 and text[start].isalnum() and text[start - 1].isalnum():
+                    continue
+                if i + 1 < length and text[i].isalnum() and text[i + 1].isalnum():
+                    continue
+                found.add(id)
+        return found
+
+
+def _compile_knowledge(knowledge_data: dict) -> tuple[KeywordAutomaton, List[str]]:
+    """ Builds the keyword automaton and description list that search_knowledge uses from a knowledge dictionary """
+    automaton = KeywordAutomaton()
+    descriptions = []
+    for keyword, value in knowledge_data.items():
+        id = len(descriptions)
+        if isinstance(value, dict):
+            descriptions.append(value.get("description", ""))
+            aliases = value.get("aliases", [])
+        else:
+            descriptions.append(value)
+            aliases = []
+        for name in [keyword, *aliases]:
+            automaton.add(name.lower().strip(), id)
+    automaton.build()
+    return (automaton, descriptions)
+
+
 def add_to_memory(data: str) -> None:
     start_time = time.time()
     data_embedding = _get_embedding(data)
     if data_embedding is not None: 
-        memory.append({"data": data, "embedding": data_embedding})
+        with memory_reload_lock, memory_lock:
+            _append_to_memory([data], data_embedding)
     end_time = time.time()
     funcs.v_print(f"Added to memory in {end_time - start_time:0.3f} seconds.")
 
 
 def add_list_to_memory(data: List[str]) -> None:
+    if len(data) == 0:
+        return
     start_time = time.time()
     data_emeddings = _get_embedding(data)
-    for i, data_embedding in enumerate(data_emeddings):
-        memory.append({"data": data[i], "embedding": data_embedding})
+    with memory_reload_lock, memory_lock:
+        _append_to_memory(data, data_emeddings)
     end_time = time.time()
     funcs.v_print(f"Added list to memory in {end_time - start_time:0.3f} seconds.")
 
 
+def add_to_memory_async(data: str, persist: bool = False) -> None:
+    """ Queues data to be added to memory by the background writer without blocking the caller. If persist is set it is also saved to memory.json """
+    memory_writer.add(data, persist)
+
+
+def flush_memory_writes(timeout: float | None = None) -> bool:
+    """ Waits until everything queued with add_to_memory_async is searchable, returns False on timeout """
+    return memory_writer.flush(timeout)
+
+
+class MemoryWriter:
+    """ Background worker for runtime memory insertion. Pending texts are batched, encoded in a single model call on the worker thread, and published to memory in one step under memory_lock """
+    def __init__(self, batch_size: int = 64, linger: float = 0.05, journal_delay: float = 5.0):
+        self.batch_size = batch_size       # Max texts per model call
+        self.linger = linger               # How long to wait for more texts after the first one arrives
+        self.journal_delay = journal_delay # How long the journal has to sit idle before it gets merged into memory.json
+        self.queue = Queue()
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    def add(self, data: str, persist: bool = False) -> None:
+        with self.idle:
+            self.pending += 1
+        self.queue.put((data, persist))
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(name="memory-writer-thread", target=self._run, daemon=True)
+                self.thread.start()
+
+    def flush(self, timeout: float | None = None) -> bool:
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout=timeout)
+
+    def _run(self) -> None:
+        journal_dirty = False
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.journal_delay if journal_dirty else None)]
+            except Empty:
+                compact_memory_journal()
+                journal_dirty = False
+                continue
+            deadline = time.time() + self.linger
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0.0, deadline - time.time())))
+                except Empty:
+                    break
+            try:
+                start_time = time.time()
+                texts = [data for data, _ in batch]
+                embeddings = _get_embedding(texts)
+                persisted = [data for data, persist in batch if persist]
+                # a reload in progress would publish its snapshot of memory over this batch, so wait for it. Journaling first means the next reload merges it in
+                with memory_reload_lock:
+                    if len(persisted) > 0:
+                        _append_to_journal(persisted)
+                        journal_dirty = True
+                    with memory_lock:
+                        _append_to_memory(texts, embeddings)
+                end_time = time.time()
+                funcs.v_print(f"Background writer added {len(texts)} items to memory in {end_time - start_time:0.3f} seconds.")
+            except Exception as e:
+                print(f"Error adding to memory in background: {e}")
+            finally:
+                with self.idle:
+                    self.pending -= len(batch)
+                    self.idle.notify_all()
+
+memory_writer = MemoryWriter()
+
+
+def _append_to_journal(data: List[str]) -> None:
+    with memory_file_lock:
+        with open(memory_journal_file, 'a', encoding='utf8') as journal:
+            for item in data:
+                journal.write(json.dumps(item) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+
+
+def compact_memory_journal() -> None:
+    """ Merges items from the write-behind journal into memory.json and empties the journal """
+    with memory_file_lock:
+        if not os.path.exists(memory_journal_file):
+            return
+        try:
+            with open(memory_journal_file, 'r', encoding='utf8') as journal:
+                journaled = [json.loads(line) for line in journal if line.strip()]
+            memory_json = {"items": []}
+            if os.path.exists(memory_file):
+                with open(memory_file, 'r', encoding='utf8') as memory_file_data:
+                    memory_json = json.load(memory_file_data)
+            items = memory_json.setdefault("items", [])
+            existing = set(items)
+            for item in journaled:
+                if item not in existing:
+                    items.append(item)
+                    existing.add(item)
+            with open(memory_file + ".tmp", 'w', encoding='utf8') as memory_file_data:
+                json.dump(memory_json, memory_file_data, indent=2, ensure_ascii=False)
+            os.replace(memory_file + ".tmp", memory_file)
+            os.remove(memory_journal_file)
+            if memory_file_watcher is not None:
+                memory_file_watcher.ignore_current(memory_file) # everything merged is already in memory, no need to reload it
+            funcs.v_print(f"Merged {len(journaled)} journaled items into memory file.")
+        except Exception as e:
+            print(f"Error merging memory journal: {e}")
+
+
+def start_file_watcher() -> None:
+    """ Starts watching memory.json and knowledge.json, edits to them are applied live until opts.memory_watch_files is turned off """
+    global memory_file_watcher
+    if memory_file_watcher is not None and memory_file_watcher.is_alive():
+        return
+    knowledge_file = os.path.join(os.path.dirname(__file__), "knowledge.json")
+    memory_file_watcher = FileWatcher({memory_file: load_memory_from_file, knowledge_file: load_knowledge_from_file})
+
+
+class FileWatcher:
+    """ Polls files for changes and calls their callback once a change has settled. Polling a couple of stat calls per second is cheaper than pulling in a watcher library, and works the same on every platform """
+    def __init__(self, callbacks: Dict[str, callable], interval: float = 1.0):
+        self.callbacks = callbacks
+        self.interval = interval
+        self.seen = {path: self._signature(path) for path in callbacks}
+        self.applied = self.seen.copy()
+        self.thread = threading.Thread(target=self._run, name="memory-file-watcher", daemon=True)
+        self.thread.start()
+
+    def is_alive(self) -> bool:
+        return self.thread.is_alive()
+
+    def ignore_current(self, path: str) -> None:
+        """ Marks the current version of a file as already applied, for changes made by the assistant itself """
+        signature = self._signature(path)
+        self.seen[path] = signature
+        self.applied[path] = signature
+
+    @staticmethod
+    def _signature(path: str):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def _run(self) -> None:
+        while opts.memory_watch_files:
+            time.sleep(self.interval)
+            for path, callback in self.callbacks.items():
+                signature = self._signature(path)
+                if signature != self.seen[path]:
+                    self.seen[path] = signature # wait for one more poll without changes, so a half-saved file isn't loaded
+                elif signature != self.applied[path] and signature is not None:
+                    self.applied[path] = signature
+                    funcs.v_print(f"{os.path.basename(path)} changed, reloading it.")
+                    try:
+                        callback()
+                    except Exception as e:
+                        print(f"Error reloading {path}: {e}")
+
+
+def is_model_ready() -> bool:
+    return model_ready.done() and model_ready.exception() is None
+
+
 def load_memory_from_file() -> None:
+    """ Loads memory.json, or re-syncs with it if memory is already loaded: new items are encoded, removed items are dropped, and unchanged items keep their vectors """
+    global _deferred_memory_load
+    if not model_ready.done():
+        # queue the load behind the model instead of blocking the caller, unless one is already waiting
+        if _deferred_memory_load is None or _deferred_memory_load.done():
+            _deferred_memory_load = _loader.submit(load_memory_from_file)
+            funcs.v_print("Memory will be loaded once the sentence transformer is ready.")
+        return
     start_time = time.time()
-    memory_file = os.path.join(os.path.dirname(__file__), "memory.json")
     memory_file_example = os.path.join(os.path.dirname(__file__), "memory.example.json")
     if not os.path.exists(memory_file):
         if os.path.exists(memory_file_example):
             shutil.copy(memory_file_example, memory_file)
-        else: 
+        elif not os.path.exists(memory_journal_file): 
             print(f"Memory file not found: {memory_file}")
             return
-    with open(memory_file, 'r', encoding='utf8') as memory_file_data:
-        global memory
-        old_memory = memory.copy()
+    with memory_reload_lock:
+        compact_memory_journal() # don't lose items that were journaled but not merged yet, e.g. after a crash
         try: 
-            memory_json = json.load(memory_file_data)
+            with open(memory_file, 'r', encoding='utf8') as memory_file_data:
+                memory_json = json.load(memory_file_data)
             items = memory_json.get("items", [])
-            memory.clear()
-            add_list_to_memory(items)
-            # for item in items:
-            #     add_to_memory(item)
+            _reload_memory(items)
         except Exception as e:
             print(f"Error loading memory from file: {e}")
-            memory = old_memory
-        finally:
-            del old_memory
     end_time = time.time()
     funcs.v_print(f"Memory loaded from file in {end_time - start_time:0.3f} seconds.")
 
+
+def _reload_memory(items: List[str]) -> None:
+    """ Replaces memory with items, reusing the stored rows of items that are already in memory. Only the new items are encoded, and that happens outside memory_lock so searches aren't blocked by it """
+    global memory_embeddings, memory_scales, memory_index
+    with memory_lock:
+        reusable = _storage_matches_options()
+        known_rows = {}
+        if reusable:
+            for row, item in enumerate(memory):
+                known_rows.setdefault(item, row)
+    new_items = list(dict.fromkeys(item for item in items if item not in known_rows))
+    new_embeddings = None
+    if len(new_items) > 0:
+        # a partial reload has to tell the cache which items are still live, so it can keep their vectors when it compacts
+        live_keys = [_content_hash(item) for item in items] if len(known_rows) > 0 else None
+        new_embeddings = torch.from_numpy(_encode_with_cache(new_items, live_keys)).to("cuda" if cuda.is_available() else "cpu")
+
+    with memory_lock:
+        if reusable and not _storage_matches_options():
+            # the storage options changed while encoding, so the old rows can't be reused anymore
+            _reload_memory(items)
+            return
+        count = len(items)
+        kept_positions = [i for i, item in enumerate(items) if item in known_rows]
+        new_positions = [i for i, item in enumerate(items) if item not in known_rows]
+        new_codes, new_scales = (None, None)
+        if new_embeddings is not None:
+            new_embeddings = _prepare_embeddings(new_embeddings)
+            new_codes, new_scales = _quantize(new_embeddings) if opts.memory_storage == "int8" else (new_embeddings, None)
+        template = memory_embeddings if len(kept_positions) > 0 else new_codes
+        if template is None:
+            memory.clear()
+            memory_embeddings = None
+            memory_scales = None
+            memory_index = None
+            _memory_changed()
+            return
+        device = template.device
+        store = torch.empty((max(count, 64), template.shape[1]), dtype=template.dtype, device=device)
+        scales = torch.empty(max(count, 64), dtype=torch.float32, device=device) if opts.memory_storage == "int8" else None
+        kept_rows = None
+        if len(kept_positions) > 0:
+            kept_rows = torch.tensor([known_rows[items[i]] for i in kept_positions], dtype=torch.long, device=device)
+            kept_positions = torch.tensor(kept_positions, dtype=torch.long, device=device)
+            store[kept_positions] = memory_embeddings.index_select(0, kept_rows)
+            if scales is not None:
+                scales[kept_positions] = memory_scales.index_select(0, kept_rows)
+        new_rows = None
+        if len(new_positions) > 0:
+            new_index = {item: row for row, item in enumerate(new_items)}
+            new_rows = torch.tensor([new_index[items[i]] for i in new_positions], dtype=torch.long, device=device)
+            new_positions = torch.tensor(new_positions, dtype=torch.long, device=device)
+            store[new_positions] = new_codes.index_select(0, new_rows)
+            if scales is not None:
+                scales[new_positions] = new_scales.index_select(0, new_rows)
+
+        remap_index = memory_index is not None and kept_rows is not None and memory_index.size() == len(memory)
+        if remap_index:
+            memory_index.remap(count, kept_positions, kept_rows, new_positions, new_embeddings.index_select(0, new_rows) if new_rows is not None else None)
+        removed = len(set(memory) - set(items))
+        memory[:] = items
+        memory_embeddings = store
+        memory_scales = scales
+        if not remap_index:
+            memory_index = None
+            _rebuild_memory_index()
+        _memory_changed()
+    funcs.v_print(f"Memory reloaded: kept {len(kept_positions)}, added {len(new_positions)}, removed {removed} items.")
+
+
+def _storage_matches_options() -> bool:
+    """ Returns True if the stored embeddings use the dtype and dimension the current options ask for. Caller must hold memory_lock """
+    if memory_embeddings is None or len(memory) == 0:
+        return False
+    if (memory_embeddings.dtype == torch.int8) != (opts.memory_storage == "int8"):
+        return False
+    full_dim = model.get_sentence_embedding_dimension()
+    expected_dim = opts.memory_matryoshka_dim if 0 < opts.memory_matryoshka_dim < full_dim else full_dim
+    return memory_embeddings.shape[1] == expected_dim
+
 def load_knowledge_from_file() -> None:
     import copy
     start_time = time.time()
@@ -124,12 +726,14 @@ def load_knowledge_from_file() -> None:
             print(f"Knowledge file not found: {knowledge_file}")
             return
     with open(knowledge_file, 'r', encoding='utf8') as knowledge_file_data:
-        global knowledge
+        global knowledge, knowledge_automaton, knowledge_descriptions
         old_knowledge = copy.deepcopy(knowledge)
         try: 
             knowledge_json = json.load(knowledge_file_data)
+            automaton, descriptions = _compile_knowledge(knowledge_json)
             knowledge.clear()
             knowledge.update(knowledge_json)
+            knowledge_automaton, knowledge_descriptions = automaton, descriptions
         except Exception as e:
             print(f"Error loading knowledge from file: {e}")
             knowledge = old_knowledge
@@ -139,14 +743,230 @@ def load_knowledge_from_file() -> None:
     funcs.v_print(f"Knowledge loaded from file in {end_time - start_time:0.3f} seconds.")
 
 
-def _get_similarity(query_embedding, db, top_k=top_k) -> List[List[Dict[str, int | float]]]:
-    db_embedding = [x["embedding"] for x in db]
-    return semantic_search(query_embedding, db_embedding, top_k=top_k)
+def _append_to_memory(data: List[str], data_embeddings) -> None:
+    """ Normalizes (and optionally truncates and quantizes) embeddings and writes them into the contiguous memory matrix, growing it geometrically when full. Caller must hold memory_lock """
+    global memory_embeddings, memory_scales, memory_index
+    data_embeddings = _prepare_embeddings(data_embeddings.reshape(len(data), -1))
+    data_codes, data_scales = _quantize(data_embeddings) if opts.memory_storage == "int8" else (data_embeddings, None)
+    count = len(memory)
+    needed = count + len(data)
+    dim = data_codes.shape[1]
+    device = data_codes.device
+    reindex = False
+    if memory_embeddings is None or memory_embeddings.shape[1] != dim or memory_embeddings.dtype != data_codes.dtype or memory_embeddings.device != device:
+        # storage format changed, carry over what's already stored in the new format
+        old_rows = _memory_rows(slice(0, count)).to(device) if memory_embeddings is not None and count > 0 else None
+        reindex = memory_embeddings is not None and memory_embeddings.shape[1] != dim
+        memory_embeddings = torch.empty((max(needed, 64), dim), dtype=data_codes.dtype, device=device)
+        memory_scales = torch.empty(max(needed, 64), dtype=torch.float32, device=device) if data_scales is not None else None
+        if old_rows is not None:
+            old_rows = _prepare_embeddings(old_rows)
+            if old_rows.shape[1] != dim:
+                # dimensions that were truncated away can't be grown back, so what's stored gets encoded again, mostly out of the embedding cache
+                old_items = memory[:count]
+                old_rows = _prepare_embeddings(torch.from_numpy(_encode_with_cache(old_items, [_content_hash(item) for item in old_items])).to(device))
+            old_codes, old_scales = _quantize(old_rows) if data_scales is not None else (old_rows, None)
+            memory_embeddings[:count] = old_codes
+            if old_scales is not None:
+                memory_scales[:count] = old_scales
+    elif needed > memory_embeddings.shape[0]:
+        # double the capacity so appending one item at a time stays amortized O(1)
+        capacity = max(needed, memory_embeddings.shape[0] * 2)
+        grown = torch.empty((capacity, dim), dtype=memory_embeddings.dtype, device=device)
+        grown[:count] = memory_embeddings[:count]
+        memory_embeddings = grown
+        if memory_scales is not None:
+            grown_scales = torch.empty(capacity, dtype=torch.float32, device=device)
+            grown_scales[:count] = memory_scales[:count]
+            memory_scales = grown_scales
+    memory_embeddings[count:needed] = data_codes
+    if data_scales is not None:
+        memory_scales[count:needed] = data_scales
+    memory.extend(data)
+    if reindex: # the index was built at the old dimension
+        memory_index = None
+        _rebuild_memory_index()
+    elif memory_index is not None and memory_index.size() == count:
+        memory_index.add(data_embeddings)
+    _memory_changed()
+
+
+def _prepare_embeddings(embeddings):
+    """ Truncates (n x dim) embeddings to the configured Matryoshka dimension and L2-normalizes them """
+    embeddings = embeddings.float()
+    if 0 < opts.memory_matryoshka_dim < embeddings.shape[1]:
+        embeddings = embeddings[:, :opts.memory_matryoshka_dim]
+    return F.normalize(embeddings, p=2, dim=1)
+
+
+def _quantize(embeddings) -> tuple:
+    """ Symmetric per-row int8 quantization, returns (codes, scales) with row ~= codes * scale """
+    scales = embeddings.abs().amax(dim=1).clamp(min=1e-12) / 127
+    codes = torch.round(embeddings / scales.unsqueeze(1)).to(torch.int8)
+    return (codes, scales)
+
+
+def _memory_rows(rows):
+    """ Returns memory rows (a slice or tensor of indices) as float embeddings, dequantizing them if memory is stored as int8 """
+    if memory_scales is None:
+        return memory_embeddings[rows]
+    return memory_embeddings[rows].float() * memory_scales[rows].unsqueeze(1)
+
+
+def _encode_with_cache(data: List[str], live_keys: List[str] | None = None) -> np.ndarray:
+    """ Returns normalized float embeddings of data, row for row. Items found in the on-disk embedding cache are read from it and only the misses go through the model.
+    live_keys are the content hashes of every memory item if data is only the new part of memory, otherwise data is taken to be all of memory and the cache is compacted down to it """
+    start_time = time.time()
+    keys = [_content_hash(item) for item in data]
+    segments = _read_embedding_cache()
+    cached_rows = {} # key -> (segment, row), later segments win
+    for segment, (segment_keys, _) in enumerate(segments):
+        for row, key in enumerate(segment_keys):
+            cached_rows[key] = (segment, row)
+    hit_positions = [i for i, key in enumerate(keys) if key in cached_rows]
+    miss_positions = [i for i, key in enumerate(keys) if key not in cached_rows]
+
+    embeddings = None
+    if len(hit_positions) > 0:
+        embeddings = np.empty((len(data), segments[0][1].shape[1]), dtype=np.float32)
+        for segment, (_, segment_embeddings) in enumerate(segments):
+            positions = [i for i in hit_positions if cached_rows[keys[i]][0] == segment]
+            if len(positions) > 0:
+                # fancy indexing copies the rows out of the memory map, so the files can be rewritten below
+                embeddings[positions] = segment_embeddings[[cached_rows[keys[i]][1] for i in positions]]
+    miss_embeddings = None
+    if len(miss_positions) > 0:
+        miss_embeddings = _get_embedding([data[i] for i in miss_positions])
+        miss_embeddings = F.normalize(miss_embeddings.reshape(len(miss_positions), -1).float(), p=2, dim=1).cpu().numpy()
+        if embeddings is None:
+            embeddings = np.empty((len(data), miss_embeddings.shape[1]), dtype=np.float32)
+        embeddings[miss_positions] = miss_embeddings
+
+    if live_keys is None:
+        # only rewrite the cache if something was added, some cached items no longer exist in the memory file, or it's split into segments
+        if len(miss_positions) > 0 or len(cached_rows) != len(set(keys)) or len(segments) > 1:
+            _write_embedding_cache(keys, embeddings)
+    elif len(miss_positions) > 0:
+        if len(segments) < embedding_cache_max_segments:
+            _append_embedding_cache([keys[i] for i in miss_positions], miss_embeddings)
+        else:
+            # too many small segments, merge everything that's still live back into one file
+            data_rows = {key: i for i, key in enumerate(keys)}
+            merged_keys = [key for key in dict.fromkeys(live_keys) if key in data_rows or key in cached_rows]
+            merged = np.empty((len(merged_keys), embeddings.shape[1]), dtype=np.float32)
+            for i, key in enumerate(merged_keys):
+                if key in data_rows:
+                    merged[i] = embeddings[data_rows[key]]
+                else:
+                    segment, row = cached_rows[key]
+                    merged[i] = segments[segment][1][row]
+            _write_embedding_cache(merged_keys, merged)
+    del segments
+    end_time = time.time()
+    funcs.v_print(f"Loaded {len(hit_positions)} cached and encoded {len(miss_positions)} new memory items in {end_time - start_time:0.3f} seconds.")
+    return embeddings
+
+
+def _content_hash(data: str) -> str:
+    return hashlib.sha1(data.encode("utf8")).hexdigest()
+
+
+def _embedding_cache_index_path() -> str:
+    """ Returns the path of the cache index for the current sentence transformer model """
+    model_slug = re.sub(r'[^a-zA-Z0-9._-]+', '_', opts.sentence_transformer_model)
+    return os.path.join(embedding_cache_dir, f"{model_slug}.json")
+
+
+def _read_embedding_cache_index() -> List[dict]:
+    """ Returns the segments listed in the cache index of the current model, each one is {"embeddings": file name, "keys": content hashes} """
+    index_file = _embedding_cache_index_path()
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file, 'r', encoding='utf8') as index_file_data:
+        cache_index = json.load(index_file_data)
+    if cache_index.get("model") != opts.sentence_transformer_model:
+        print(f"Embedding cache {index_file} is for a different model, ignoring it")
+        return []
+    if "segments" not in cache_index: # single file layout
+        return [{"embeddings": cache_index.get("embeddings", ""), "keys": cache_index.get("keys", [])}]
+    return cache_index["segments"]
+
+
+def _read_embedding_cache() -> List[tuple[List[str], np.ndarray]]:
+    """ Returns (content hashes, read-only memory map of their embeddings) for each cache segment """
+    try:
+        segments = []
+        for segment in _read_embedding_cache_index():
+            keys = segment.get("keys", [])
+            embeddings = np.load(os.path.join(embedding_cache_dir, segment.get("embeddings", "")), mmap_mode='r')
+            if embeddings.ndim != 2 or embeddings.shape[0] != len(keys) or (segments and embeddings.shape[1] != segments[0][1].shape[1]):
+                print(f"Embedding cache {_embedding_cache_index_path()} doesn't match, ignoring it")
+                return []
+            segments.append((keys, embeddings))
+        return segments
+    except Exception as e:
+        print(f"Error reading embedding cache: {e}")
+        return []
+
+
+def _write_embedding_cache(keys: List[str], embeddings: np.ndarray) -> None:
+    """ Replaces the embedding cache of the current model with the given rows as a single segment, dropping duplicate keys """
+    unique_rows = {}
+    for row, key in enumerate(keys):
+        unique_rows.setdefault(key, row)
+    try:
+        old_segments = _read_embedding_cache_index()
+    except Exception:
+        old_segments = []
+    segment = _save_embedding_segment(list(unique_rows.keys()), embeddings[list(unique_rows.values())])
+    if segment is not None:
+        _save_embedding_cache_index([segment], [old_segment.get("embeddings") for old_segment in old_segments])
+
+
+def _append_embedding_cache(keys: List[str], embeddings: np.ndarray) -> None:
+    """ Adds rows to the embedding cache as a new segment, so a reload that adds a few items doesn't rewrite the whole cache """
+    try:
+        segments = _read_embedding_cache_index()
+    except Exception as e:
+        print(f"Error reading embedding cache: {e}")
+        return
+    segment = _save_embedding_segment(keys, embeddings)
+    if segment is not None:
+        _save_embedding_cache_index(segments + [segment], [])
+
+
+def _save_embedding_segment(keys: List[str], embeddings: np.ndarray) -> dict | None:
+    """ Writes embeddings to a new file, returns its segment entry for the index """
+    embeddings_name = f"{os.path.splitext(os.path.basename(_embedding_cache_index_path()))[0]}.{time.time_ns()}.npy"
+    try:
+        os.makedirs(embedding_cache_dir, exist_ok=True)
+        np.save(os.path.join(embedding_cache_dir, embeddings_name), np.ascontiguousarray(embeddings, dtype=np.float32))
+        return {"embeddings": embeddings_name, "keys": keys}
+    except Exception as e:
+        print(f"Error writing embedding cache: {e}")
+        return None
+
+
+def _save_embedding_cache_index(segments: List[dict], obsolete_files: List[str]) -> None:
+    """ Points the cache index at segments, then deletes files that are no longer used.
+    The embeddings always go to new files first and the index is swapped over to them in one os.replace, so a crash mid-write never leaves keys pointing at the wrong rows """
+    global rescore_source
+    rescore_source = None # lets go of the memory maps, so the old files can be deleted
+    index_file = _embedding_cache_index_path()
+    try:
+        with open(index_file + ".tmp", 'w', encoding='utf8') as index_file_data:
+            json.dump({"model": opts.sentence_transformer_model, "segments": segments}, index_file_data)
+        os.replace(index_file + ".tmp", index_file)
+        for embeddings_name in obsolete_files:
+            if embeddings_name and os.path.exists(os.path.join(embedding_cache_dir, embeddings_name)):
+                os.remove(os.path.join(embedding_cache_dir, embeddings_name))
+    except Exception as e:
+        print(f"Error writing embedding cache: {e}")
 
 
 def _get_embedding(query):
     device = "cuda" if cuda.is_available() else "cpu"
-    return model.encode(query, convert_to_tensor=True, precision="float32", device=device)
+    return model_ready.result().encode(query, convert_to_tensor=True, precision="float32", device=device) # waits for the model if it's still loading
 
 
 if __name__ == "__main__":
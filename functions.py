@@ -5,13 +5,14 @@ import json
 import os
 import re
 import shutil
-from typing import Callable, Optional
+from typing import Callable, List, Optional
 import wave
 import pyaudio
 import time
 import struct
 import threading
 from io import BytesIO
+from queue import Queue, Empty
 
 import vrcutils as vrc
 import options as opts
@@ -326,11 +327,8 @@ def clip_audio_end(audio_bytes: BytesIO) -> BytesIO:
 
 # region Text Functions
 
-def cut_up_text(text: str) -> None:
-    """ Cuts text into segments of 144 chars that are pushed one by one to VRC Chatbox """
-    # if isinstance(opts.tts_engine, ttsutils.AllTalkTTS):
-    return cut_up_text_slow(text)
-    
+def split_text_for_chatbox(text: str) -> List[str]:
+    """ Splits text into segments that fit in the VRC Chatbox, breaking at punctuation or spaces where possible """
     txt = text
     segments = []
     while len(txt) > 142:
@@ -346,6 +344,15 @@ def cut_up_text(text: str) -> None:
         segments.append(chunk)
         txt = txt[last_punc_index+1:]
     segments.append(txt)
+    return segments
+
+
+def cut_up_text(text: str) -> None:
+    """ Cuts text into segments of 144 chars that are pushed one by one to VRC Chatbox """
+    # if isinstance(opts.tts_engine, ttsutils.AllTalkTTS):
+    return cut_up_text_slow(text)
+    
+    segments = split_text_for_chatbox(text)
 
     i = 0
     list = []
@@ -373,21 +380,7 @@ def cut_up_text(text: str) -> None:
 
 def cut_up_text_slow(text: str) -> None:
     """ Same method as above but alternates between pushing text to the chatbox and getting new tts generations, for engines that take longer """
-    txt = text
-    segments = []
-    while len(txt) > 142:
-        punctuation_markers = ['.', ',', '!', '?', ')', ']', '}', '>', ':', ';', '"', '\n']
-        last_indices = [txt[:141].rfind(punc) for punc in punctuation_markers]
-        last_punc_index = max(last_indices)
-        if last_punc_index == -1:
-            last_punc_index = txt[:141].rfind(' ')
-        if last_punc_index == -1:
-            last_punc_index = 141
-        chunk = txt[:last_punc_index]
-        chunk = chunk.replace('\n', ' ')
-        segments.append(chunk)
-        txt = txt[last_punc_index+1:]
-    segments.append(txt)
+    segments = split_text_for_chatbox(text)
 
     i = 0
     for i, segment in enumerate(segments):
@@ -475,9 +468,9 @@ def clear_between_tags(text, start_tag="<think>", end_tag="<\\/think>") -> str:
 #endregion
 
 
-def faster_whisper_transcribe(model, recording) -> tuple[bool, str | None]:
+def faster_whisper_transcribe(recording) -> tuple[bool, str | None]:
     """ Transcribes audio in .wav file to text using Faster Whisper """
-    if model is None:
+    if opts.whisper_model is None:
         return (False, "Whisper model not loaded")
     if opts.whisper_task == 'transcribe':
         vrc.chatbox('✍️ Transcribing...')
@@ -486,12 +479,16 @@ def faster_whisper_transcribe(model, recording) -> tuple[bool, str | None]:
         vrc.chatbox('[あ>A] Translating...')
         v_print('~Translating...')
 
+    import whisper_models # it imports this module
     with opts.whisper_lock:
+        model = opts.whisper_model # read it again now that it can't be swapped out
+        if model is None:
+            return (False, "Whisper model not loaded")
         start_time = time.perf_counter()
         # audio = ffmpeg_for_whisper(recording) # This adds 500ms of latency with no apparent benefit 
         # Initialize transcription object on the recording
         segments, info = model.transcribe(
-            recording, task=opts.whisper_task, beam_size=opts.whisper_beams, initial_prompt=opts.whisper_prompt, no_speech_threshold=0.3, log_prob_threshold=0.8)
+            recording, task=opts.whisper_task, beam_size=whisper_models.beam_size(), initial_prompt=opts.whisper_prompt, no_speech_threshold=0.3, log_prob_threshold=0.8)
 
         v_print(f'lang: {info.language}, {info.language_probability * 100:.1f}%')
 
@@ -558,3 +555,145 @@ def tts(text):
     opts.speaking = False
 
 
+class SpeechStream:
+    """ Speaks a reply while it's still being generated. Tokens are fed in as they arrive, each sentence is sent to the TTS engine on a worker thread as soon as it ends,
+    and a second thread plays the clips and shows their text in the chatbox in order. Speaking starts after the first sentence instead of after the whole reply """
+    sentence_end = re.compile(r'[.!?]+["\')\]*]*\s+|\n+')
+
+    def __init__(self):
+        self.text = ''     # raw text fed so far
+        self.cut = 0       # how much of the spoken text has been handed to the synthesis thread
+        self.spoke = False
+        self.cancelled = False
+        self.sentences = Queue() # sentences waiting for TTS, None once the reply is finished
+        self.clips = Queue()     # (text, audio) waiting to be played, None once everything was synthesized
+        self.last_progress = time.perf_counter() # when a sentence was last synthesized or played, to tell a stuck TTS call from a long reply
+        self.synth_thread = threading.Thread(target=self._synthesize, name="tts-synth-thread", daemon=True)
+        self.play_thread = threading.Thread(target=self._play, name="tts-play-thread", daemon=True)
+        self.synth_thread.start()
+        self.play_thread.start()
+
+    def _spoken_text(self) -> str:
+        """ The text that should be spoken, without <think> blocks, cut off at a <think> that hasn't been closed yet """
+        text = clear_between_tags(self.text)
+        open_tag = text.lower().find("<think>")
+        return text if open_tag == -1 else text[:open_tag]
+
+    def feed(self, token: str) -> None:
+        """ Adds a token of the reply, queues any sentences it finished """
+        if self.cancelled or len(token) == 0:
+            return
+        self.text += token
+        text = self._spoken_text()
+        last_end = None
+        for last_end in self.sentence_end.finditer(text, self.cut):
+            pass
+        if last_end is not None:
+            self._queue_sentences(text[self.cut:last_end.end()])
+            self.cut = last_end.end()
+
+    def _queue_sentences(self, text: str) -> None:
+        start = 0
+        for end in self.sentence_end.finditer(text):
+            sentence = text[start:end.end()].strip()
+            start = end.end()
+            if len(sentence) > 0:
+                self.sentences.put(sentence)
+                self.spoke = True
+        if len(text[start:].strip()) > 0:
+            self.sentences.put(text[start:].strip())
+            self.spoke = True
+
+    stall_timeout = 30.0 # seconds without anything being synthesized or played before finish() gives up
+
+    def finish(self, wait: bool = True) -> bool:
+        """ Queues whatever is left of the reply and optionally waits for it to finish playing. Returns True if anything was spoken.
+        Stops waiting and cancels the rest if nothing happens for stall_timeout seconds, so a hung TTS call can't freeze the main loop """
+        if not self.cancelled:
+            self._queue_sentences(self._spoken_text()[self.cut:])
+        self.sentences.put(None)
+        if wait:
+            while self.play_thread.is_alive():
+                self.play_thread.join(timeout=0.5)
+                if self.play_thread.is_alive() and time.perf_counter() - self.last_progress > self.stall_timeout:
+                    print(f"!!Speech got stuck for {self.stall_timeout:.0f}s, skipping the rest")
+                    self.cancel()
+                    break
+        return self.spoke
+
+    def cancel(self) -> None:
+        """ Drops everything that hasn't been played yet """
+        self.cancelled = True
+        self.sentences.put(None)
+        self.clips.put(None) # in case the synthesis thread is stuck and never sends its own
+
+    def _synthesize(self) -> None:
+        finished = False
+        following = None
+        try:
+            while not finished:
+                sentence = following if following is not None else self.sentences.get()
+                following = None
+                if sentence is None:
+                    break
+                # sentences that piled up while the last one was being synthesized get spoken together, so the chatbox doesn't flash through short fragments
+                while len(sentence) < 142:
+                    try:
+                        following = self.sentences.get_nowait()
+                    except Empty:
+                        break
+                    if following is None:
+                        finished = True
+                        break
+                    if len(sentence) + len(following) + 1 > 142:
+                        break
+                    sentence += ' ' + following
+                    following = None
+                if self.cancelled or opts.panic:
+                    continue
+                for segment in split_text_for_chatbox(sentence):
+                    filtered_text = ttsutils.filter(segment)
+                    audio = None
+                    try:
+                        if len(filtered_text.strip()) > 0:
+                            audio = opts.tts_engine.tts(filtered_text)
+                            if audio is None:
+                                opts.panic = True
+                                break
+                            if not isinstance(opts.tts_engine, (ttsutils.ElevenTTS, ttsutils.GoogleTranslateTTS)): # those return mp3 instead of wav
+                                audio = clip_audio_end(audio)
+                    except Exception as e:
+                        print(f"!!TTS failed, skipping \"{segment}\": {e}")
+                        continue
+                    finally:
+                        self.last_progress = time.perf_counter()
+                    self.clips.put((segment, audio))
+        finally:
+            self.clips.put(None)
+
+    def _play(self) -> None:
+        try:
+            while True:
+                clip = self.clips.get()
+                if clip is None:
+                    break
+                if self.cancelled or opts.panic:
+                    continue
+                segment, audio = clip
+                self.last_progress = time.perf_counter()
+                with opts.is_speaking_lock:
+                    opts.speaking = True
+                    vrc.chatbox(f'🤖 {segment}')
+                    if audio is not None:
+                        try:
+                            audio.seek(0)
+                            play_sound(audio)
+                        except Exception as e:
+                            print(f"!!Failed to play \"{segment}\": {e}")
+                        finally:
+                            audio.close()
+                self.last_progress = time.perf_counter()
+        finally:
+            opts.speaking = False
+
+
@@ -8,17 +8,19 @@ import numpy as np
 import pyaudio
 import speech_recognition as sr
 
+import threading
 import time
-from queue import Queue
+from queue import Queue, Empty
 
 from whisper_online import FasterWhisperASR, OnlineASRProcessor
+import whisper_models
 
 import options as opts
 import functions as funcs
 import vrcutils as vrc
+import chatgpt
 
 # region Continuous Listening
-FasterWhisperASR.whisper_compute_type = opts.whisper_compute_type
 
 # Thread safe Queue for passing data from the threaded recording callback.
 data_queue = Queue()
@@ -28,6 +30,78 @@ recorder.energy_threshold = opts.recording_threshold
 recorder.dynamic_energy_threshold = False
 
 
+class VoiceActivityDetector:
+    """ Cheap frame level speech detector to run before any Whisper work. Audio is split into 20ms frames, and a frame counts as speech if its energy is
+    opts.vad_threshold_db above the background noise floor, which is tracked from the frames that aren't speech. Speech is extended by opts.vad_hangover
+    seconds at the end and opts.vad_pre_roll seconds at the start, carried over between chunks """
+    sample_rate = 16000
+    frame_length = 320       # 20ms
+    min_energy_db = -55.0    # frames quieter than this are never speech, whatever the noise floor
+    noise_adapt_rate = 0.05  # per frame, how fast the noise floor follows the background
+    noise_rise_rate = 0.005  # per frame, how fast it rises when nothing is quiet enough, so a sudden loud background (music) isn't speech forever
+
+    def __init__(self, noise_floor_db: float | None = None):
+        self.noise_floor_db = noise_floor_db if noise_floor_db is not None else self.min_energy_db # starting guess, it adapts from there
+        self.pre_roll = np.zeros(0, dtype=np.float32) # the end of the last chunk, in case speech starts right at the beginning of the next one
+        self.remainder = np.zeros(0, dtype=np.float32) # samples left over that don't fill a frame yet
+        self.hangover_left = 0   # frames of hangover carried over from the last chunk
+        self.samples_seen = 0    # samples processed so far, the position of the next chunk in the whole stream
+        self.emitted_until = 0   # position in the whole stream where the last returned audio ended, so pre-roll never repeats it
+
+    def reset(self) -> None:
+        """ Forgets the audio around the last chunk, but keeps the noise floor """
+        self.pre_roll = np.zeros(0, dtype=np.float32)
+        self.remainder = np.zeros(0, dtype=np.float32)
+        self.hangover_left = 0
+        self.emitted_until = self.samples_seen
+
+    def process(self, audio: np.ndarray) -> np.ndarray:
+        """ Returns the part of the audio around any speech in it, with pre-roll and hangover, or an empty array if it's only noise """
+        audio = np.concatenate((self.remainder, audio))
+        frame_count = len(audio) // self.frame_length
+        self.remainder = audio[frame_count * self.frame_length:]
+        audio = audio[:frame_count * self.frame_length]
+        if frame_count == 0:
+            return audio
+        chunk_start = self.samples_seen
+        self.samples_seen += len(audio)
+        frames = audio.reshape(frame_count, self.frame_length)
+        energy_db = 10 * np.log10(np.mean(np.square(frames), axis=1) + 1e-10)
+        speech = (energy_db > self.noise_floor_db + opts.vad_threshold_db) & (energy_db > self.min_energy_db)
+
+        # hangover: a frame is active if there was speech in it or in the last hangover_frames frames, counting the ones carried over
+        hangover_frames = int(opts.vad_hangover * self.sample_rate / self.frame_length)
+        index = np.arange(frame_count)
+        last_speech = np.maximum.accumulate(np.where(speech, index, -10**9))
+        active = (index - last_speech <= hangover_frames) | (index < self.hangover_left)
+        self.hangover_left = max(hangover_frames - (frame_count - 1 - int(last_speech[-1])), 0) if speech.any() else max(self.hangover_left - frame_count, 0)
+
+        # the noise floor follows the background, dropping right away if it gets quieter
+        quiet = energy_db[~speech]
+        if len(quiet) > 0:
+            rate = 1 - (1 - self.noise_adapt_rate) ** len(quiet)
+            self.noise_floor_db = min(float(np.min(quiet)), self.noise_floor_db + rate * (float(np.mean(quiet)) - self.noise_floor_db))
+        else:
+            rate = 1 - (1 - self.noise_rise_rate) ** frame_count
+            self.noise_floor_db += rate * (float(np.min(energy_db)) - self.noise_floor_db)
+
+        pre_roll_samples = int(opts.vad_pre_roll * self.sample_rate)
+        previous_pre_roll = self.pre_roll
+        self.pre_roll = np.concatenate((previous_pre_roll, audio))[-pre_roll_samples:] if pre_roll_samples > 0 else audio[:0]
+        if not active.any():
+            return audio[:0]
+        active_frames = np.flatnonzero(active)
+        start = int(active_frames[0]) * self.frame_length
+        end = (int(active_frames[-1]) + 1) * self.frame_length
+        # pre-roll only reaches back to where the last returned audio ended, e.g. when speech starts again right after a hangover
+        first = max(chunk_start + start - pre_roll_samples, self.emitted_until)
+        self.emitted_until = chunk_start + end
+        if first >= chunk_start:
+            return audio[first - chunk_start:end]
+        missing = chunk_start - first # pre-roll that has to come from the end of the last chunk
+        return np.concatenate((previous_pre_roll[max(len(previous_pre_roll) - missing, 0):], audio[:end]))
+
+
 def record_callback(_, audio:sr.AudioData) -> None:
         """
         Threaded callback function to receive audio data when recordings finish.
@@ -46,10 +120,9 @@ def record_callback(_, audio:sr.AudioData) -> None:
 
 
 # Main function for listening to the microphone and processing speech.
+# It runs as three stages: the SpeechRecognition callback captures audio into data_queue, capture_stage drains it, filters it and decides where phrases end,
+# and the decode loop here runs Whisper on whatever has piled up. A slow decode never holds up the capture, so the end of a phrase is timed from when the audio arrived.
 def run():
-    # The last time a recording was retrieved from the queue.
-    phrase_time = None
-
     source = sr.Microphone(sample_rate=16000, device_index=int(funcs.vb_out))
 
     transcription = ''
@@ -62,96 +135,147 @@ def run():
     recorder.listen_in_background(source, record_callback, phrase_time_limit=opts.max_recording_time)
     recorder.pause_threshold = opts.silence_timeout
 
-    phrase_time = -1
-    phrase_complete = True
-
-    # Load / Download model
+    # Load / Download model, or borrow it if it's loaded already
     start_time = time.time()
-    asr = FasterWhisperASR("en", opts.whisper_model_size)
+    whisper_models.load_model()
+    asr = FasterWhisperASR("en", model=whisper_models.get_model)
     online = OnlineASRProcessor(asr)
     end_time = time.time()
     funcs.v_print(f"Time taken to load model: {end_time - start_time:4.3f} seconds")
 
+    capture_thread = threading.Thread(target=capture_stage, name="listening-capture-thread", daemon=True)
+    capture_thread.start()
+
     # Cue the user that we're ready to go.
     print("Speech Recognition Model loaded.\n")
-    
+
+    scheduler = DecodeScheduler()
+    new_audio = 0.0   # seconds of audio inserted into online since the last decode
     while True:
         try:
-            # If the audio trigger is disabled, we can't listen for audio.
-            if not opts.audio_trigger_enabled:
-                phrase_complete = False
-                phrase_time = -1
-                data_queue.queue.clear()
-                time.sleep(0.1)
-                continue
-            # If we're generating or speaking, we shouldn't listen for audio.
-            if opts.generating or opts.speaking:
-                phrase_complete = False
-                phrase_time = -1
-                data_queue.queue.clear()
-                time.sleep(0.1)
-                continue
+            try:
+                item = speech_queue.get(timeout=scheduler.wait_time(new_audio))
+            except Empty:
+                item = None
+            # take everything else that's already waiting, one decode covers all of it
+            while isinstance(item, np.ndarray):
+                online.insert_audio_chunk(item)
+                new_audio += len(item) / OnlineASRProcessor.SAMPLING_RATE
+                try:
+                    item = speech_queue.get_nowait()
+                except Empty:
+                    item = None
+            if new_audio > 0 and (item is PHRASE_END or scheduler.ready(new_audio)):
+                start_time = time.perf_counter()
+                # o : tuple[Start, End, Transcription] 
+                asr.beam_size = whisper_models.beam_size()
+                with opts.whisper_lock: # keeps the model from being swapped out mid-decode
+                    o : tuple[Any|None, Any|None, str] = online.process_iter()
+                scheduler.record(start_time, time.perf_counter() - start_time)
+                new_audio = 0.0
+                # print(f"Partial result: {o}")
+                if o[0] is not None:
+                    transcription += o[2]
+                    # committed text won't change anymore, so start looking up memory for it while the user keeps talking
+                    chatgpt.prefetch_retrieval(transcription)
+                if (opts.verbosity): print(f"{transcription}", end="\r")
+            if item is PHRASE_END:
+                # vrc.chatbox('✏ Processing...')
+                result = finished_transcription(online, transcription)
+                funcs.v_print(f"\n\nFinal Transcription: \n{result}\n\n")
+                transcription = ''
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            # keep listening, e.g. if there's no Whisper model right now because loading one failed
+            print(f"!!Error while transcribing: {e}")
+
+
+PHRASE_END = object()   # put in speech_queue after the last audio of a phrase
+speech_queue = Queue(maxsize=32) # audio with speech in it, from capture_stage to the decode loop
+
+
+def capture_stage() -> None:
+    """ Drains data_queue as fast as audio arrives, drops what isn't speech, and passes the rest on to the decode loop through speech_queue.
+    Also decides when a phrase is over, from the time the last speech was heard. If the decode loop falls behind, audio is merged into bigger chunks instead of blocking """
+    # adjust_for_ambient_noise put the recorder's threshold a bit above the room noise, which is a good place for the noise floor to start
+    vad = VoiceActivityDetector(20 * np.log10(max(recorder.energy_threshold, 1) / 32768))
+    pending = []              # audio that didn't fit in speech_queue yet, followed by PHRASE_END if the phrase is over
+    last_speech_time = None   # when the last speech of the current phrase was heard, None between phrases
+    while True:
+        # If the audio trigger is disabled, or we're generating or speaking, we shouldn't listen for audio.
+        if not opts.audio_trigger_enabled or opts.generating or opts.speaking:
+            data_queue.queue.clear()
+            vad.reset()
+            if last_speech_time is not None: # finish what was said so far
+                pending.append(PHRASE_END)
+                last_speech_time = None
+        else:
             now = time.time()
+            audio_np = None
             # Pull raw recorded audio from the queue if it's not empty.
             if not data_queue.empty():
-                phrase_complete = False
-                # If enough time has passed between recordings, consider the phrase complete.
-                # Clear the current working audio buffer to start over with the new data.
-                if phrase_time and phrase_time != -1 and (now - phrase_time) > opts.silence_timeout:
-                    phrase_complete = True
-                    opts.trigger = False
-                    # if opts.sound_feedback:
-                    #     funcs.play_sound_threaded(funcs.speech_off)
-                    funcs.v_print("~Phrase Complete")
-                
                 # Combine audio data from queue
                 audio_data = b''.join(data_queue.queue)
                 data_queue.queue.clear()
-
-                # This is the last time we received new audio data from the queue.
-                phrase_time = now
-                
                 # Convert in-ram buffer to something the model can use directly without needing a temp file.
                 # Convert data from 16 bit wide integers to floating point with a width of 32 bits.
                 # Clamp the audio stream frequency to a PCM wavelength compatible default of 32768hz max.
                 audio_np = np.frombuffer(audio_data, dtype=np.int16).astype(np.float32) / 32768.0
+                if opts.vad_enabled:
+                    audio_np = vad.process(audio_np)
+                    if len(audio_np) == 0: # only background noise, carry on as if nothing was heard
+                        audio_np = None
+            if audio_np is not None:
+                if last_speech_time is None:
+                    chatgpt.prewarm_connection() # the user started a new phrase, get the connection ready for when it's done
+                last_speech_time = now
+                pending.append(audio_np)
+            elif last_speech_time is not None and (now - last_speech_time) > opts.silence_timeout:
+                # If enough time has passed since the last speech, consider the phrase complete.
+                opts.trigger = False
+                # if opts.sound_feedback:
+                #     funcs.play_sound_threaded(funcs.speech_off)
+                funcs.v_print("~Phrase Complete")
+                pending.append(PHRASE_END)
+                last_speech_time = None
+        while len(pending) > 0 and not speech_queue.full():
+            if pending[0] is PHRASE_END:
+                speech_queue.put(pending.pop(0))
+                continue
+            end = next((i for i, item in enumerate(pending) if item is PHRASE_END), len(pending))
+            speech_queue.put(np.concatenate(pending[:end]))
+            del pending[:end]
+        # Infinite loops are bad for processors, must sleep.
+        time.sleep(0.1 if not opts.audio_trigger_enabled or opts.generating or opts.speaking else 0.02)
 
-                # Process this chunk of audio
-                start_time = time.time()
-                online.insert_audio_chunk(audio_np)
-                # o : tuple[Start, End, Transcription] 
-                o : tuple[Any|None, Any|None, str] = online.process_iter()
-                end_time = time.time()
-                transcription_time = end_time - start_time
-                # Adding this line since on slower PCs it has the chance to stop the recording early due to how long processing takes.
-                if transcription_time > (opts.silence_timeout):
-                    phrase_time += transcription_time
-                # print(f"Partial result: {o}")
-                if o[0] is not None:
-                    transcription += o[2]
 
-                if (opts.verbosity): print(f"{transcription}", end="\r")
+class DecodeScheduler:
+    """ Decides when the decode loop runs Whisper again, the way whisper_online's computation aware simulation does. Every decode transcribes the whole
+    buffer, so the next one only starts once min_chunk seconds have passed, or as long as decodes have been taking if that's longer.
+    On a slow model each decode then covers more audio instead of falling further and further behind """
+    min_chunk = 1.0       # seconds
+    smoothing = 0.3
 
-                # If we detected a pause between recordings, add a new item to our transcription.
-                # Otherwise edit the existing one.
-                if phrase_complete:
-                    # vrc.chatbox('✏ Processing...')
-                    result = finished_transcription(online, transcription)
-                    funcs.v_print(f"\n\nFinal Transcription: \n{result}\n\n")
-                    transcription = ''
-            else:
-                if (now - phrase_time) > opts.silence_timeout and not phrase_complete:
-                    phrase_complete = True
-                    phrase_time = -1
-                    # vrc.chatbox('✏ Processing...')
-                    result = finished_transcription(online, transcription)
-                    funcs.v_print(f"\n\nFinal Transcription: \n{result}\n\n")
-                    transcription = ''
-                else:
-                    # Infinite loops are bad for processors, must sleep.
-                    time.sleep(0.05)
-        except KeyboardInterrupt:
-            break
+    def __init__(self):
+        self.decode_time = 0.0  # moving average of how long process_iter takes
+        self.last_start = 0.0
+
+    def interval(self) -> float:
+        return max(self.min_chunk, self.decode_time)
+
+    def ready(self, new_audio: float) -> bool:
+        return new_audio >= self.interval() or time.perf_counter() - self.last_start >= self.interval()
+
+    def wait_time(self, new_audio: float) -> float:
+        """ How long the decode loop can wait for more audio before it's time to decode """
+        if new_audio == 0:
+            return 1.0
+        return max(self.interval() - (time.perf_counter() - self.last_start), 0.01)
+
+    def record(self, start_time: float, decode_time: float) -> None:
+        self.last_start = start_time
+        self.decode_time += self.smoothing * (decode_time - self.decode_time)
 
 
 # Called when end of speech is detected
@@ -164,9 +288,9 @@ def finished_transcription(online, transcription) -> str:
     online.init()
     transcription = transcription.strip()
     if len(transcription) > 0:
+        chatgpt.prefetch_retrieval(transcription)
         funcs.queue_message(transcription)
         opts.bot_responded = False
-    data_queue.queue.clear()
     return transcription
 
 # endregion
@@ -232,6 +356,7 @@ def loop():
                 frames.append(data)
                 vrc.chatbox('👂 Listening...')
                 funcs.v_print("~Recording...")
+                chatgpt.prewarm_connection()
                 recording = True
                 # set timeout to now + SILENCE_TIMEOUT seconds
                 silence_timeout_timer = time.time() + opts.silence_timeout
@@ -283,11 +408,12 @@ def loop():
 
 def process_transcription_and_respond(phrase: BytesIO):
     vrc.set_parameter(opts.vrc_thinking_parameter.get("name"), opts.vrc_thinking_parameter.get("value_on"))
-    result: tuple[bool, str|None] = funcs.faster_whisper_transcribe(opts.whisper_model, phrase)
+    result: tuple[bool, str|None] = funcs.faster_whisper_transcribe(phrase)
     if result is None or not result[0]:
         funcs.v_print("Nothing returned from transcription because: " + result[1])
         vrc.set_parameter(opts.vrc_thinking_parameter.get("name"), opts.vrc_thinking_parameter.get("value_off"))
         return
+    chatgpt.prefetch_retrieval(result[1])
     with opts.is_speaking_lock:
         funcs.queue_message(result[1])
         opts.bot_responded = False
@@ -0,0 +1,118 @@
+# metrics.py (c) 2024 MissingNO123
+# Description: This module keeps per-request latency metrics for chat generations, so a slow turn can be traced to retrieval, prompt building, prefill (time to first token) or the provider's token rate. The most recent requests are kept in memory and can be exported as JSON or CSV.
+
+import csv
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import List, Dict
+
+import options as opts
+
+fields = [
+    "timestamp", "model", "provider", "prompt_build_time", "retrieval_time", "time_to_first_token", "total_time",
+    "inter_token_p50", "inter_token_p90", "inter_token_p99", "prompt_tokens", "cached_tokens", "completion_tokens", "tokens_per_second",
+    "tool_calls", "error"
+]
+
+history = deque(maxlen=opts.metrics_history) # Ring buffer of the most recent request metrics, oldest first
+history_lock = threading.Lock()
+
+
+class RequestTimer:
+    """ Collects the timings of one generation as it happens, call finish() once it's done to add it to the history """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.prompt_built_time = None
+        self.request_time = None
+        self.token_times = []
+        self.retrieval_time = None
+        self.finished = False
+
+    def prompt_built(self, retrieval_time: float | None = None) -> None:
+        self.prompt_built_time = time.perf_counter()
+        self.retrieval_time = retrieval_time
+
+    def request_sent(self) -> None:
+        self.request_time = time.perf_counter()
+
+    def token(self) -> None:
+        self.token_times.append(time.perf_counter())
+
+    def finish(self, model: str, provider: str, usage: dict | None = None, tool_calls: int = 0, error: str | None = None) -> dict:
+        end_time = time.perf_counter()
+        self.finished = True
+        request_time = self.request_time or self.prompt_built_time or self.start_time
+        gaps = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+        usage = usage or {}
+        completion_tokens = usage.get("completion_tokens") or len(self.token_times)
+        decode_time = self.token_times[-1] - self.token_times[0] if len(self.token_times) > 1 else 0
+        entry = {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "model": model,
+            "provider": provider,
+            "prompt_build_time": (self.prompt_built_time - self.start_time) if self.prompt_built_time else None,
+            "retrieval_time": self.retrieval_time,
+            "time_to_first_token": (self.token_times[0] - request_time) if self.token_times else None,
+            "total_time": end_time - self.start_time,
+            "inter_token_p50": percentile(gaps, 50),
+            "inter_token_p90": percentile(gaps, 90),
+            "inter_token_p99": percentile(gaps, 99),
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "cached_tokens": usage.get("cached_tokens"),
+            "completion_tokens": completion_tokens,
+            # rate after the first token, so it's the provider's generation speed without the prefill and queueing in front of it.
+            # uses the token count from usage when there is one, since a stream chunk can hold more than one token
+            "tokens_per_second": (completion_tokens - 1) / decode_time if decode_time > 0 else None,
+            "tool_calls": tool_calls,
+            "error": error,
+        }
+        record(entry)
+        return entry
+
+
+def percentile(values: List[float], p: float) -> float | None:
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def record(entry: dict) -> None:
+    global history
+    with history_lock:
+        if history.maxlen != opts.metrics_history: # resized from the settings
+            history = deque(history, maxlen=opts.metrics_history)
+        history.append(entry)
+
+
+def get_history() -> List[dict]:
+    with history_lock:
+        return list(history)
+
+
+def summary() -> Dict[str, dict]:
+    """ Median time to first token and tokens/sec per model and provider, over the requests in the history """
+    groups = {}
+    for entry in get_history():
+        groups.setdefault(f'{entry["model"]} @ {entry["provider"]}', []).append(entry)
+    return {key: {
+                "requests": len(entries),
+                "errors": sum(1 for entry in entries if entry["error"]),
+                "time_to_first_token_p50": percentile([entry["time_to_first_token"] for entry in entries if entry["time_to_first_token"] is not None], 50),
+                "tokens_per_second_p50": percentile([entry["tokens_per_second"] for entry in entries if entry["tokens_per_second"] is not None], 50),
+            } for key, entries in groups.items()}
+
+
+def export_json(path: str) -> None:
+    with open(path, 'w', encoding='utf8') as json_file:
+        json.dump({"requests": get_history(), "summary": summary()}, json_file, indent=2)
+
+
+def export_csv(path: str) -> None:
+    with open(path, 'w', encoding='utf8', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(get_history())
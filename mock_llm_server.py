@@ -0,0 +1,182 @@
+# mock_llm_server.py (c) 2024 MissingNO123
+# Description: A local stand-in for an OpenAI-compatible chat completions API, for testing and benchmarking without a live provider. It streams a canned reply with a configurable time to first token and token rate, can answer with tool calls, and can inject errors or drop the connection mid-stream. Run it on two ports to try hedging.
+
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+reply_words = ("Sure thing! I can hear you loud and clear, and honestly this world looks pretty great tonight. "
+               "Let me know if you want me to look something up, or if you just want to keep chatting for a while.").split(" ")
+
+
+class MockLLMServer:
+    """ Serves /v1/chat/completions on a thread of its own. Settings can be changed while it's running.
+    request_times has how long the server spent on each request, from reading it to writing the last byte, so a client can tell its own overhead apart from the simulated generation """
+    def __init__(self, port: int = 8001, ttft: float = 0.2, tokens_per_second: float = 50.0, tokens: int = 40, tool_calls: List[str] | None = None,
+                 error_rate: float = 0.0, error_status: int = 500, disconnect_rate: float = 0.0, model: str = "mock-model", quiet: bool = True):
+        self.ttft = ttft                           # seconds before the first token
+        self.tokens_per_second = tokens_per_second # 0 = as fast as possible
+        self.tokens = tokens                       # reply length, capped by the request's max_tokens
+        self.tool_calls = tool_calls or []         # names of the functions to call when the request offers tools
+        self.error_rate = error_rate               # chance of answering with error_status instead
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate     # chance of dropping the connection halfway through the reply
+        self.model = model
+        self.quiet = quiet
+        self.request_times = []
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}/v1"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=f"mock-llm-{self.port}", daemon=True)
+
+    def start(self) -> "MockLLMServer":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # keep-alive, so connection pooling on the client side gets exercised
+
+            def setup(self):
+                super().setup()
+                # every token is a tiny write, without this Nagle's algorithm holds them back waiting for ACKs and adds ~40ms to the first token
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, format, *args):
+                if not server.quiet:
+                    super().log_message(format, *args)
+
+            def do_HEAD(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                start_time = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                server.requests += 1
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    return self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                try:
+                    request = json.loads(body)
+                except json.JSONDecodeError as e:
+                    return self._send_json(400, {"error": {"message": f"Invalid JSON: {e}", "type": "invalid_request_error"}})
+                if random.random() < server.error_rate:
+                    time.sleep(server.ttft)
+                    return self._send_json(server.error_status, {"error": {"message": "Injected error", "type": "server_error"}})
+                messages = request.get("messages") or []
+                # call tools once per user turn, the follow-up after the results is a normal reply
+                call_tools = len(server.tool_calls) > 0 and request.get("tools") and not (len(messages) > 0 and messages[-1].get("role") == "tool")
+                token_count = min(server.tokens, request.get("max_tokens") or server.tokens)
+                completion_id = f"chatcmpl-mock{server.requests}"
+                if not request.get("stream"):
+                    time.sleep(server.ttft + (token_count / server.tokens_per_second if server.tokens_per_second > 0 else 0))
+                    message = {"role": "assistant", "content": " ".join(reply_words[i % len(reply_words)] for i in range(token_count))}
+                    if call_tools:
+                        message = {"role": "assistant", "content": None, "tool_calls": [{"id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": "{}"}} for i, name in enumerate(server.tool_calls)]}
+                    self._send_json(200, {"id": completion_id, "object": "chat.completion", "model": server.model,
+                                          "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if call_tools else "stop"}],
+                                          "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": token_count, "total_tokens": len(body) // 4 + token_count}})
+                    server.request_times.append(time.perf_counter() - start_time)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(server.ttft)
+                try:
+                    if call_tools:
+                        deltas = []
+                        for i, name in enumerate(server.tool_calls):
+                            deltas.append({"tool_calls": [{"index": i, "id": f"call_{i}", "type": "function", "function": {"name": name, "arguments": ""}}]})
+                            deltas += [{"tool_calls": [{"index": i, "function": {"arguments": piece}}]} for piece in ("{", "}")] # arguments arrive in pieces like they do from OpenAI
+                        finish_reason = "tool_calls"
+                    else:
+                        deltas = [{"content": (" " if i > 0 else "") + reply_words[i % len(reply_words)]} for i in range(token_count)]
+                        finish_reason = "stop"
+                    disconnect_at = random.randrange(len(deltas)) if random.random() < server.disconnect_rate else None
+                    for i, delta in enumerate(deltas):
+                        if i == disconnect_at:
+                            self.close_connection = True
+                            return
+                        if i > 0 and server.tokens_per_second > 0:
+                            time.sleep(1 / server.tokens_per_second)
+                        self._send_event({"id": completion_id, "object": "chat.completion.chunk", "model": server.model, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                    self._send_event({"id": completion_id, "object": "chat.completion.chunk", "model": server.model, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+                    if (request.get("stream_options") or {}).get("include_usage"):
+                        self._send_event({"id": completion_id, "object": "chat.completion.chunk", "model": server.model, "choices": [],
+                                          "usage": {"prompt_tokens": len(body) // 4, "completion_tokens": len(deltas), "total_tokens": len(body) // 4 + len(deltas)}})
+                    self._send_chunk(b"data: [DONE]\n\n")
+                    self._send_chunk(b"")
+                    server.request_times.append(time.perf_counter() - start_time)
+                except (BrokenPipeError, ConnectionResetError): # the client cancelled
+                    self.close_connection = True
+
+            def _send_event(self, data: dict) -> None:
+                self._send_chunk(f"data: {json.dumps(data)}\n\n".encode())
+
+            def _send_chunk(self, data: bytes) -> None:
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, status: int, data: dict) -> None:
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return Handler
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--ttft', type=float, default=0.2, help="Seconds before the first token.")
+    parser.add_argument('--tokens_per_second', type=float, default=50.0, help="Token rate after the first token, 0 = as fast as possible.")
+    parser.add_argument('--tokens', type=int, default=40, help="Number of tokens in each reply.")
+    parser.add_argument('--tool_calls', type=str, default="", help="Comma separated function names to call when the request offers tools.")
+    parser.add_argument('--error_rate', type=float, default=0.0, help="Chance of answering a request with an error.")
+    parser.add_argument('--error_status', type=int, default=500, help="HTTP status of injected errors.")
+    parser.add_argument('--disconnect_rate', type=float, default=0.0, help="Chance of dropping the connection in the middle of a reply.")
+
+
+def server_from_arguments(args, port: int, **overrides) -> MockLLMServer:
+    settings = dict(ttft=args.ttft, tokens_per_second=args.tokens_per_second, tokens=args.tokens, tool_calls=[name for name in args.tool_calls.split(",") if name],
+                    error_rate=args.error_rate, error_status=args.error_status, disconnect_rate=args.disconnect_rate)
+    settings.update(overrides)
+    return MockLLMServer(port, **settings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8001, help="Port to listen on.")
+    parser.add_argument('--second_port', type=int, default=0, help="Also serve a second instance on this port, e.g. as the hedge_api_url.")
+    parser.add_argument('--second_ttft', type=float, default=None, help="Time to first token of the second instance, same as --ttft if not given.")
+    parser.add_argument('--verbose', action="store_true", default=False, help="Log every request.")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    servers = [server_from_arguments(args, args.port, quiet=not args.verbose).start()]
+    if args.second_port:
+        servers.append(server_from_arguments(args, args.second_port, quiet=not args.verbose, ttft=args.second_ttft if args.second_ttft is not None else args.ttft).start())
+    for server in servers:
+        print(f"Mock chat completions API on {server.url} (ttft {server.ttft}s, {server.tokens_per_second} tok/s, {server.tokens} tokens)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for server in servers:
+            server.stop()
@@ -19,6 +19,13 @@ whisper_device = "cuda"                 # cuda | cpu
 # whisper_compute_type = "int8_float16"   # int8 | int8_float16 | float16 | float32
 whisper_compute_type = "int8_float16"   # int8 | int8_float16 | float16 | float32
 whisper_beams = 5                       # Number of beams to use for beam search
+whisper_cpu_compute_type = "int8"       # compute type when running on the CPU: int8 | float32
+whisper_cpu_threads = 0                 # CPU threads for Whisper, 0 = let CTranslate2 decide
+whisper_cpu_beams = 0                   # beam size on the CPU, picked by the autotune for whisper_autotuned_for, 0 = same as whisper_beams
+whisper_num_workers = 1                 # transcriptions that can run at once, more only helps if several run in parallel
+whisper_autotune = True                 # On the CPU, find the fastest threads and compute type for this machine the first time a model is loaded, and save them
+whisper_rtf_target = 0.5                # Real-time factor (seconds spent per second of audio) that counts as fast enough, below 1 to leave room for re-transcribing in continuous mode
+whisper_autotuned_for = ""              # which model and machine the CPU settings were tuned for, set by the autotune
 whisper_lock = threading.Lock()
 whisper_model = None
 
@@ -36,6 +43,7 @@ vrc_thinking_parameter = {
 # Program options
 verbosity: bool = False               # Print debug messages to console
 chatbox: bool = True                  # Send messages to VRChat chatbox
+stream_tts: bool = True               # Start speaking each sentence of a reply while the rest is still being generated
 parrot_mode: bool = False             # Echo back user's messages
 sound_feedback: bool = True            # Play sound feedback when recording/stopped/misrecognized
 audio_trigger_enabled: bool = False   # Trigger voice recording on volume threshold
@@ -55,8 +63,22 @@ gpt = "GPT-4"                   # GPT-3 | GPT-4 | custom
 custom_model_name = ""          # Custom model name to use if GPT is set to custom
 custom_api_url = "http://localhost:1234/v1" # Server to use if GPT is set to custom               
 gpt_providers = []              # Providers to use for GPT, in order of preference, if using OpenRouter
+use_async_client = True         # Stream completions with the asyncio client, which can stop a generation and close its connection immediately when panicking
+hedge_enabled = False           # Also send the request to a second backend if the first one is slow to produce a token, and use whichever answers first. Needs use_async_client
+hedge_api_url = ""              # Second backend to hedge with, OpenAI-compatible. Uses the HEDGE_API_KEY environment variable, or the OpenAI key if it's on the same host, otherwise no key
+hedge_model_name = ""           # Model to ask the second backend for, empty = same model
+hedge_delay = 2.0               # Seconds to wait for the first token before hedging
+hedge_adaptive = True           # Hedge after the first backend's usual (p90) time to first token instead, if that's shorter
+prewarm_connection = True       # Open the connection to the API when the user starts speaking, so the request doesn't pay for the handshake
 max_tokens = 200                # Max tokens that will try to generate
 max_conv_length = 10            # Max length of conversation buffer
+enable_tools = False            # Let the model call functions to look up VRChat player info, costs extra prompt tokens
+prompt_cache_layout = False     # Keep the start of the prompt the same every turn so the provider can cache it, and put changing info in a message at the end
+prompt_context_role = "user"    # user | system. With prompt_cache_layout, "user" puts the changing info at the start of the last user message, which every chat template accepts. "system" sends it as its own system message after the conversation, which some (e.g. Mistral, Gemma) reject
+max_context_tokens = 2000       # Token budget of the conversation buffer, the oldest messages are dropped once it's exceeded (0 = no limit)
+summarize_evicted = False       # Keep a short summary of dropped messages in the system prompt
+metrics_enabled = True          # Record time to first token, tokens/sec and where the time went for every generation
+metrics_history = 500           # How many generations to keep metrics for, export them with the "exportmetrics" command
 temperature = 1.5               # Sane values are 0.0 - 1.0 (higher = more random)
 frequency_penalty = 1.2
 presence_penalty = 0.5
@@ -67,7 +89,15 @@ top_k = 69
 # Memory options
 sentence_transformer_model = "sentence-transformers/all-mpnet-base-v2"
 similarity_threshold = 0.5      # Threshold for semantic memory search results to be considered
+memory_index = "exact"          # exact | ivf (approximate search, only kicks in for large memory stores)
+memory_index_probes = 16        # Number of IVF lists to search per query, higher = better recall but slower
+memory_storage = "float32"      # float32 | int8 (4x less RAM, scores are approximate)
+memory_matryoshka_dim = 0       # Truncate memory embeddings to this many dimensions, 0 = keep all. Only use with Matryoshka-trained models
+memory_rescore = True           # With int8 storage, rescore the best candidates against their original float embeddings from the embedding cache
+memory_rescore_multiplier = 4   # How many candidates per result to rescore
 memory_top_k = 5                # Number of memory search results to return
+memory_watch_files = False      # Reload memory.json and knowledge.json automatically when they're edited
+speculative_retrieval = True    # Search memory and knowledge with the partial transcript while the user is still talking
 
 # TTS options
 tts_engine = None
@@ -94,6 +124,10 @@ alltalk_selected_rvc_voice = ""
 recording_threshold: float = 10.0    # adjust this to set the minimum volume threshold to start/stop recording
 max_recording_time: float = 30.0     # maximum recording time in seconds
 silence_timeout: float = 2.0         # timeout in seconds for detecting silence
+vad_enabled: bool = True             # Only pass audio to Whisper if it sounds like speech, so background noise doesn't get transcribed over and over
+vad_threshold_db: float = 9.0        # how many dB above the background noise a frame has to be to count as speech
+vad_hangover: float = 0.3            # seconds of audio to keep after speech stops, so word endings aren't cut off
+vad_pre_roll: float = 0.2            # seconds of audio to keep before speech starts, so the first word isn't cut off
 OUTPUT_FILENAME = "recording.wav"
 
 # System Prompt
@@ -115,6 +149,7 @@ bot_responded = True
 
 message_array = [] # List of messages sent back and forth between AI / User, can be initialized with example messages
 message_queue = [] # Queue of messages to be processed and added to message_array
+conversation_summary = "" # Rolling summary of messages that were dropped from message_array
 example_messages = []
 
 # endregion
@@ -127,6 +162,13 @@ safe_keys = [
     "whisper_device",
     "whisper_compute_type",
     "whisper_beams",
+    "whisper_cpu_compute_type",
+    "whisper_cpu_threads",
+    "whisper_cpu_beams",
+    "whisper_num_workers",
+    "whisper_autotune",
+    "whisper_rtf_target",
+    "whisper_autotuned_for",
 
     "vrc_ip",
     "vrc_osc_inport",
@@ -134,6 +176,7 @@ safe_keys = [
 
     "verbosity",
     "chatbox",
+    "stream_tts",
     "parrot_mode",
     "sound_feedback",
     "audio_trigger_enabled",
@@ -147,8 +190,22 @@ safe_keys = [
     "custom_model_name",
     "custom_api_url",
     "gpt_providers",
+    "use_async_client",
+    "hedge_enabled",
+    "hedge_api_url",
+    "hedge_model_name",
+    "hedge_delay",
+    "hedge_adaptive",
+    "prewarm_connection",
     "max_tokens",
     "max_conv_length",
+    "enable_tools",
+    "prompt_cache_layout",
+    "prompt_context_role",
+    "max_context_tokens",
+    "summarize_evicted",
+    "metrics_enabled",
+    "metrics_history",
     "temperature",
     "frequency_penalty",
     "presence_penalty",
@@ -158,7 +215,15 @@ safe_keys = [
 
     "sentence_transformer_model",
     "similarity_threshold",
+    "memory_index",
+    "memory_index_probes",
+    "memory_storage",
+    "memory_matryoshka_dim",
+    "memory_rescore",
+    "memory_rescore_multiplier",
     "memory_top_k",
+    "memory_watch_files",
+    "speculative_retrieval",
 
     "tts_engine_name",
     "windows_tts_voice_id",
@@ -175,6 +240,10 @@ safe_keys = [
     "recording_threshold",
     "max_recording_time",
     "silence_timeout",
+    "vad_enabled",
+    "vad_threshold_db",
+    "vad_hangover",
+    "vad_pre_roll",
 
     "bot_name",
     "bot_personality",
@@ -223,8 +292,9 @@ def load_config():
             else:
                 print( f'!! "{key}" found in config file doesn\'t correlate to a setting' )
     
-    global message_array, gcloud_voice_name
+    global message_array, conversation_summary, gcloud_voice_name
     message_array = example_messages.copy()
+    conversation_summary = ""
     gcloud_voice_name = f"{gcloud_language_code}-{gcloud_tts_type}-{gcloud_letter_id}"
     if len(gpt_providers) > 0:
         import chatgpt #cursed but it might work
@@ -233,5 +303,7 @@ def load_config():
     import embeddings as emb
     emb.load_memory_from_file()
     emb.load_knowledge_from_file()
+    if memory_watch_files:
+        emb.start_file_watcher()
 
 # endregion
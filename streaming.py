@@ -0,0 +1,203 @@
+# streaming.py (c) 2024 MissingNO123
+# Description: This module reads streamed chat completions. A StreamConsumer parses each chunk once, collects the reply text and tool calls, and hands the text to sinks (console, UI, chatbox, TTS), each of which decides for itself how often it's worth updating.
+
+import sys
+import time
+from typing import Callable, List
+
+import options as opts
+import functions as funcs
+import vrcutils as vrc
+
+
+class StreamCancelled(Exception):
+    """ Raised by a stream that was cancelled before it finished, e.g. by the panic key """
+
+
+class Sink:
+    """ Receives the text of a reply as it streams in. Text is buffered and passed to emit() at most once every interval seconds (0 = every token), and whatever is left when the stream ends """
+    interval = 0.0
+
+    def __init__(self, interval: float | None = None):
+        if interval is not None:
+            self.interval = interval
+        self.pending = []
+        self.last_flush = 0.0
+
+    def write(self, text: str) -> None:
+        self.pending.append(text)
+        if self.ready(text):
+            self.flush()
+
+    def ready(self, text: str) -> bool:
+        """ Whether the buffered text should be emitted now, text is what was just written """
+        return time.perf_counter() - self.last_flush >= self.interval
+
+    def flush(self) -> None:
+        if len(self.pending) > 0:
+            text = ''.join(self.pending)
+            self.pending.clear()
+            self.emit(text)
+        self.last_flush = time.perf_counter()
+
+    def emit(self, text: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.flush()
+
+
+class ConsoleSink(Sink):
+    """ Prints the reply, flushing stdout a few times a second instead of after every token """
+    interval = 0.05
+
+    def emit(self, text: str) -> None:
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+
+class CallbackSink(Sink):
+    """ Passes batches of text to a function, e.g. one that inserts it into a text box. Tk redraws on every insert, so it's batched the same as the console """
+    interval = 0.05
+
+    def __init__(self, callback: Callable[[str], None], interval: float | None = None):
+        super().__init__(interval)
+        self.callback = callback
+
+    def emit(self, text: str) -> None:
+        self.callback(text)
+
+
+class ChatboxSink(Sink):
+    """ Shows the end of the reply so far in the VRChat chatbox. VRChat rate limits chatbox messages, so it only updates every couple of seconds """
+    interval = 2.0
+
+    def __init__(self, interval: float | None = None):
+        super().__init__(interval)
+        self.text = ''
+        self.last_flush = time.perf_counter() # leave "Thinking..." up for the first interval
+
+    def emit(self, text: str) -> None:
+        self.text += text
+        shown = funcs.clear_between_tags(self.text).strip()
+        open_tag = shown.lower().find("<think>")
+        if open_tag != -1:
+            shown = shown[:open_tag].strip()
+        if len(shown) == 0:
+            return
+        if len(shown) > 140:
+            shown = '…' + shown[-139:]
+        vrc.chatbox(f'🤖 {shown}')
+
+    def close(self) -> None:
+        self.pending.clear() # the finished reply gets shown properly by whoever asked for it
+
+
+class SpeechSink(Sink):
+    """ Feeds a funcs.SpeechStream. It only needs whole sentences, so text is held back until a sentence could have ended """
+    sentence_chars = ('.', '!', '?', '\n')
+
+    def __init__(self, speech: funcs.SpeechStream):
+        super().__init__()
+        self.speech = speech
+
+    def ready(self, text: str) -> bool:
+        return any(char in text for char in self.sentence_chars)
+
+    def emit(self, text: str) -> None:
+        self.speech.feed(text)
+
+
+class ToolCallAccumulator:
+    """ Puts tool calls back together from a stream. The arguments of each call arrive in pieces spread over many chunks, keyed by the index of the call """
+    def __init__(self):
+        self.calls = {} # index -> {"id", "type", "function": {"name", "arguments"}}
+
+    def add(self, delta: dict) -> None:
+        tool_call_deltas = delta.get("tool_calls") or []
+        if delta.get("function_call"): # old single function_call format
+            tool_call_deltas = [{"index": 0, "function": delta["function_call"]}]
+        for tool_call_delta in tool_call_deltas:
+            index = tool_call_delta.get("index", len(self.calls))
+            tool_call = self.calls.setdefault(index, {"id": f"call_{index}", "type": "function", "function": {"name": "", "arguments": ""}})
+            if tool_call_delta.get("id"):
+                tool_call["id"] = tool_call_delta["id"]
+            function = tool_call_delta.get("function") or {}
+            tool_call["function"]["name"] += function.get("name") or ""
+            tool_call["function"]["arguments"] += function.get("arguments") or ""
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def result(self) -> List[dict]:
+        return [self.calls[index] for index in sorted(self.calls)]
+
+
+class StreamConsumer:
+    """ Reads a chat completion stream once, collecting the reply and any tool calls, and fans the text out to its sinks.
+    on_usage gets the chunks that carry token usage, timer (a metrics.RequestTimer) gets a tick for every token """
+    def __init__(self, sinks: List[Sink] | None = None, on_usage: Callable[[dict], None] | None = None, timer=None):
+        self.sinks = sinks or []
+        self.on_usage = on_usage
+        self.timer = timer
+        self.parts = []
+        self.tool_calls = ToolCallAccumulator()
+        self.provider = None
+        self.cancelled = False
+        self.finish_reason = None # set by the last chunk of a stream that wasn't cut short
+
+    def add_sink(self, sink: Sink) -> None:
+        self.sinks.append(sink)
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    @property
+    def status(self) -> str | None:
+        """ None if the reply was read to the end, "Cancelled" if it was stopped, "Error" if the stream ended before the model finished """
+        if self.cancelled:
+            return "Cancelled"
+        if self.finish_reason is None:
+            return "Error"
+        return None
+
+    def consume(self, completion) -> str:
+        """ Reads the whole stream, or until the panic key is pressed or the stream is cancelled, and returns the reply text """
+        try:
+            for chunk in completion:
+                if opts.panic:
+                    self.cancelled = True
+                    break
+                self.feed(chunk)
+        except StreamCancelled:
+            self.cancelled = True
+        finally:
+            for sink in self.sinks:
+                sink.close()
+        return self.text
+
+    def feed(self, chunk) -> None:
+        """ Handles one chunk of the stream """
+        self.provider = self.provider or chunk.get('provider') # OpenRouter says which provider served the request
+        choices = chunk['choices']
+        if len(choices) == 0: # the usage chunk at the end of the stream
+            if self.on_usage is not None:
+                self.on_usage(chunk)
+            return
+        if choices[0].get('finish_reason'):
+            self.finish_reason = choices[0]['finish_reason']
+            if self.on_usage is not None:
+                self.on_usage(chunk)
+        delta = choices[0].get('delta') or {}
+        content = delta.get('content')
+        if content:
+            self.parts.append(content)
+            for sink in self.sinks:
+                sink.write(content)
+        if delta.get('tool_calls') or delta.get('function_call'):
+            self.tool_calls.add(delta)
+        elif not content:
+            return
+        if self.timer is not None:
+            self.timer.token()
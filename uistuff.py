@@ -13,7 +13,9 @@ import options as opts
 import functions as funcs
 import vrcutils as vrc
 import chatgpt
+import streaming
 import listening as ears
+import whisper_models
 import vision as eyes
 
 
@@ -425,6 +427,7 @@ class ManualTextEntryWindow(customtkinter.CTkToplevel):
         self.addtext("Messages cleared!\n")
         opts.message_array = []
         opts.message_array = opts.example_messages.copy()
+        opts.conversation_summary = ""
         print(f'$ Messages cleared!')
         self.after(1000, self.refresh_messages)
 
@@ -484,31 +487,17 @@ class ManualTextEntryWindow(customtkinter.CTkToplevel):
         try:
             # funcs.append_user_message(user_text)
             completion = chatgpt.generate(user_text, True)
-            completion_text = ''
-            is_function_call = False
-            function_args = {}
+            consumer = streaming.StreamConsumer([streaming.ConsoleSink(), streaming.CallbackSink(self.addtext)], on_usage=chatgpt.record_usage)
             print("\n>AI: ", end='')
             self.addtext("\n---\nAI: ")
-            for chunk in completion:
-                if opts.panic: break
-                event_text = ''
-                chunk_message = chunk['choices'][0]['delta']  # extract the message
-                if chunk_message.get('content'):
-                    event_text = chunk_message['content']
-                print(event_text, end='')
-                sys.stdout.flush()
-                self.addtext(event_text)
-                completion_text += event_text  # append the text
-                if chunk['choices'][0]['delta'].get('function_call'):
-                    is_function_call = True
-                    function_args = chunk['choices'][0]['delta']["function_call"]
-                    break
+            completion_text = consumer.consume(completion)
+            tool_calls = consumer.tool_calls
             end_time = time.perf_counter()
-            if is_function_call:
+            if len(tool_calls) > 0 and not opts.panic:
                 funcs.v_print(f'\n--AI Function call took {end_time - start_time:.3f}s')
                 print("[Running Function...]")
                 self.addtext("[Running Function...]\n")
-                self.result = chatgpt.call_function(function_args)
+                self.result = chatgpt.run_tool_calls(tool_calls.result(), content=funcs.clear_between_tags(completion_text).strip())
                 self.addtext(self.result)
             else: 
                 self.result = completion_text.strip()
@@ -666,12 +655,12 @@ class AIStuffFrame(customtkinter.CTkFrame):
         self.textfield_whisper_prompt = customtkinter.CTkEntry(self, width=200, placeholder_text="Whisper Prompt...", textvariable=self.whisper_prompt)
         self.textfield_whisper_prompt.grid(row=row, column=0, columnspan=2, sticky="ew", pady=2, padx=10)
         row += 1
-        # self.label_whisper_model = customtkinter.CTkLabel(self, text="Whisper Model: ", fg_color="transparent")
-        # self.label_whisper_model.grid(row=row, column=0, columnspan=2, sticky="w", pady=(4,1), padx=5)
-        # row += 1
-        # self.dropdown_whisper_model = customtkinter.CTkOptionMenu(self, variable=self.selected_whisper_model, values=self.whispermodels, command=self._set_whisper_model)
-        # self.dropdown_whisper_model.grid(row=row, column=0, columnspan=3, sticky="ew", padx=10)
-        # row += 1
+        self.label_whisper_model = customtkinter.CTkLabel(self, text="Whisper Model: ", fg_color="transparent")
+        self.label_whisper_model.grid(row=row, column=0, columnspan=2, sticky="w", pady=(4,1), padx=5)
+        row += 1
+        self.dropdown_whisper_model = customtkinter.CTkOptionMenu(self, variable=self.selected_whisper_model, values=self.whispermodels, command=self._set_whisper_model)
+        self.dropdown_whisper_model.grid(row=row, column=0, columnspan=3, sticky="ew", padx=10)
+        row += 1
         self.label_gpt_picker = customtkinter.CTkLabel(self, text="GPT Model: ", fg_color="transparent")
         self.label_gpt_picker.grid(row=row, column=0, sticky="w", pady=(4,1), padx=5)
         row += 1
@@ -789,6 +778,7 @@ class AIStuffFrame(customtkinter.CTkFrame):
     def _reset_chat_buffer(self):
         opts.message_array = []
         opts.message_array = opts.example_messages.copy()
+        opts.conversation_summary = ""
         print(f'$ Messages cleared!')
 
     def _spinbox_callback(self):
@@ -799,9 +789,22 @@ class AIStuffFrame(customtkinter.CTkFrame):
 
     def _set_whisper_model(self, choice):
         opts.whisper_model_size = choice
-        self.popup = Popup(self, window_title="Restart Required",
-                           window_text="Please restart the program to reload the whisper model", button_text="OK")
-        self.popup.after(250, self.popup.focus) # Why do I need to wait for this???
+        self.dropdown_whisper_model.configure(state="disabled")
+        swap_thread = threading.Thread(target=self._swap_whisper_model, name="whisper-swap-thread", daemon=True)
+        swap_thread.start()
+
+    def _swap_whisper_model(self):
+        """ Loads the chosen model in place of the old one, without blocking the UI """
+        vrc.chatbox('🔄 Loading Voice Recognition...')
+        try:
+            whisper_models.load_model()
+            vrc.chatbox(f'✔️ Now using Whisper {opts.whisper_model_size}')
+        except Exception as e:
+            print(f"!!Failed to load Whisper: {e}")
+            vrc.chatbox('⚠ Failed to load Voice Recognition')
+        finally:
+            # load_model puts the size back if the new one couldn't be loaded
+            self.dropdown_whisper_model.after(0, lambda: (self.selected_whisper_model.set(opts.whisper_model_size), self.dropdown_whisper_model.configure(state="normal")))
 
     def _spawn_manual_entry(self):
         if self.manual_entry_window_is_open.get() == False:
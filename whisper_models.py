@@ -0,0 +1,193 @@
+# whisper_models.py (c) 2024 MissingNO123
+# Description: This module owns the Whisper model. Both the push-to-talk and the continuous listening paths use the one loaded here (opts.whisper_model), so it's only in memory once. It follows opts.whisper_model_size, whisper_device and whisper_compute_type, and can swap to a different model while the program is running. On the CPU it can also tune the thread count and compute type for the machine it's running on.
+
+import gc
+import glob
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+import psutil
+from faster_whisper import WhisperModel
+
+import options as opts
+import functions as funcs
+
+loaded_settings = None # (model size, device, compute type, cpu threads, workers) of opts.whisper_model
+loaded_device = None   # where opts.whisper_model actually runs, "cpu" after a fallback even if the settings say otherwise
+loaded_options = None  # (whisper_model_size, whisper_device, whisper_compute_type) that opts.whisper_model was loaded for, put back if loading another one fails
+sample_rate = 16000
+load_lock = threading.Lock() # one load (and tune) at a time, so two threads loading at once don't both do it
+
+
+def model_settings() -> tuple:
+    if opts.whisper_device == "cpu":
+        return (opts.whisper_model_size, "cpu", opts.whisper_cpu_compute_type, opts.whisper_cpu_threads, opts.whisper_num_workers)
+    return (opts.whisper_model_size, opts.whisper_device, opts.whisper_compute_type, 0, opts.whisper_num_workers)
+
+
+def get_model() -> WhisperModel | None:
+    """ The model that's loaded right now. Hold opts.whisper_lock while using it, so it can't be swapped out in the middle """
+    return opts.whisper_model
+
+
+def beam_size() -> int:
+    """ Beam size to use with the loaded model. On the CPU that's the one the autotune picked for this model and machine, if there is one """
+    if loaded_device == "cpu" and opts.whisper_cpu_beams > 0 and opts.whisper_autotuned_for == _autotune_key(opts.whisper_model_size):
+        return opts.whisper_cpu_beams
+    return opts.whisper_beams
+
+
+def load_model() -> WhisperModel:
+    """ Makes sure the model in the options is the one that's loaded and returns it. Falls back to the CPU if the model can't be loaded on the GPU.
+    A different model is loaded (and tuned for the CPU) next to the old one, which keeps transcribing until it's swapped out under opts.whisper_lock.
+    If loading fails the old model stays, the model options are put back to match it, and the error is raised """
+    global loaded_settings, loaded_device, loaded_options
+    with load_lock:
+        settings = model_settings()
+        if opts.whisper_model is not None and settings == loaded_settings:
+            return opts.whisper_model
+        requested_options = (opts.whisper_model_size, opts.whisper_device, opts.whisper_compute_type)
+        try:
+            model, device = _load_with_fallback()
+        except Exception:
+            if loaded_options is not None:
+                opts.whisper_model_size, opts.whisper_device, opts.whisper_compute_type = loaded_options
+            raise
+        with opts.whisper_lock:
+            old_model = opts.whisper_model
+            opts.whisper_model = model
+            loaded_settings = model_settings() # what was asked for, so a fallback isn't retried every time
+            loaded_device = device
+            loaded_options = requested_options
+        if old_model is not None:
+            _free(old_model)
+        return model
+
+
+def _load_with_fallback() -> tuple:
+    """ Loads the model in the options, returns it and the device it ended up on """
+    settings = model_settings()
+    if settings[1] == "cpu":
+        _autotune_if_needed(settings[0])
+        return (_load(*model_settings()), "cpu")
+    try:
+        return (_load(*settings), settings[1])
+    except Exception as e:
+        print(f"!!Could not load Whisper on {settings[1]}, falling back to the CPU: {e}")
+    _autotune_if_needed(settings[0])
+    return (_load(settings[0], "cpu", opts.whisper_cpu_compute_type, opts.whisper_cpu_threads, opts.whisper_num_workers), "cpu")
+
+
+def unload_model() -> None:
+    """ Frees the loaded model. Call with opts.whisper_lock held """
+    global loaded_settings, loaded_device, loaded_options
+    model = opts.whisper_model
+    opts.whisper_model = None
+    loaded_settings = None
+    loaded_device = None
+    loaded_options = None
+    if model is None:
+        return
+    _free(model)
+
+
+def _free(model: WhisperModel) -> None:
+    # ctranslate2 frees the weights (and VRAM) right away, instead of whenever the last reference happens to go
+    if hasattr(model.model, "unload_model"):
+        model.model.unload_model()
+    del model
+    gc.collect()
+
+
+def _load(model_size: str, device: str, compute_type: str, cpu_threads: int = 0, num_workers: int = 1) -> WhisperModel:
+    threads = f", {cpu_threads} threads" if device == "cpu" and cpu_threads > 0 else ""
+    funcs.v_print(f"~Loading Whisper {model_size} on {device} ({compute_type}{threads})...")
+    start_time = time.perf_counter()
+    model = WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads, num_workers=num_workers)
+    funcs.v_print(f'--Whisper loaded in {time.perf_counter() - start_time:.3f}s')
+    return model
+
+
+def _autotune_key(model_size: str) -> str:
+    return f"{model_size} on {psutil.cpu_count(logical=False)}c/{os.cpu_count()}t"
+
+
+def _needs_autotune() -> bool:
+    return opts.whisper_autotune and opts.whisper_autotuned_for != _autotune_key(opts.whisper_model_size)
+
+
+def _autotune_if_needed(model_size: str) -> None:
+    if _needs_autotune():
+        autotune_cpu(model_size)
+
+
+def benchmark_clip() -> np.ndarray:
+    """ About ten seconds of speech, made of the prebaked TTS clips resampled to 16kHz """
+    clips = []
+    for file in sorted(glob.glob('./prebaked_tts/*.wav'))[:6]:
+        with wave.open(file, 'rb') as wav:
+            rate = wav.getframerate()
+            audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16).astype(np.float32) / 32768.0
+            if wav.getnchannels() > 1:
+                audio = audio.reshape(-1, wav.getnchannels()).mean(axis=1)
+        clips.append(np.interp(np.arange(0, len(audio) / rate, 1 / sample_rate), np.arange(len(audio)) / rate, audio).astype(np.float32))
+        clips.append(np.zeros(sample_rate // 3, dtype=np.float32))
+    if len(clips) == 0:
+        raise FileNotFoundError("no clips in ./prebaked_tts")
+    return np.concatenate(clips)
+
+
+def measure_rtf(model: WhisperModel, audio: np.ndarray, beam_size: int) -> float:
+    """ Real-time factor of transcribing the audio: seconds spent per second of audio """
+    start_time = time.perf_counter()
+    segments, info = model.transcribe(audio, language="en", beam_size=beam_size)
+    list(segments) # the transcription happens while the segments are read
+    return (time.perf_counter() - start_time) / (len(audio) / sample_rate)
+
+
+def autotune_cpu(model_size: str, persist: bool = True) -> list:
+    """ Times a few thread counts and compute types on benchmark_clip() and picks the fastest. Beam size is only lowered to 1 if nothing is fast enough
+    (opts.whisper_rtf_target) at opts.whisper_beams. With persist, the choice is saved to the config as the CPU settings (the beam size as whisper_cpu_beams,
+    so it doesn't follow the model onto the GPU) and isn't tuned again for this model and machine.
+    Returns every result, as dicts of compute_type, cpu_threads, beam_size and rtf """
+    try:
+        audio = benchmark_clip()
+    except FileNotFoundError as e:
+        print(f"!!Can't tune Whisper for this CPU: {e}")
+        return []
+    print(f"Tuning Whisper {model_size} for this CPU, this only happens once...")
+    physical_cores = psutil.cpu_count(logical=False) or os.cpu_count() or 4
+    thread_counts = sorted({max(physical_cores // 2, 1), physical_cores, os.cpu_count() or physical_cores})
+    results = []
+    for beam_size in dict.fromkeys((opts.whisper_beams, 1)):
+        for compute_type in ("int8", "float32"):
+            for cpu_threads in thread_counts:
+                try:
+                    model = _load(model_size, "cpu", compute_type, cpu_threads, opts.whisper_num_workers)
+                except Exception as e:
+                    print(f"!!Could not load Whisper {model_size} as {compute_type}: {e}")
+                    break
+                measure_rtf(model, audio[:2 * sample_rate], beam_size) # warm up
+                rtf = measure_rtf(model, audio, beam_size)
+                _free(model)
+                results.append({"compute_type": compute_type, "cpu_threads": cpu_threads, "beam_size": beam_size, "rtf": rtf})
+                funcs.v_print(f"--{compute_type}, {cpu_threads} threads, beam size {beam_size}: real-time factor {rtf:.2f}")
+        if any(result["rtf"] <= opts.whisper_rtf_target for result in results):
+            break
+    if len(results) == 0:
+        return results
+    fast_enough = [result for result in results if result["rtf"] <= opts.whisper_rtf_target]
+    best = min(fast_enough or results, key=lambda result: result["rtf"])
+    print(f'Whisper {model_size} on CPU: {best["compute_type"]}, {best["cpu_threads"]} threads, beam size {best["beam_size"]}, real-time factor {best["rtf"]:.2f}')
+    if len(fast_enough) == 0:
+        print(f"!!Whisper {model_size} is too slow for real time on this CPU (target {opts.whisper_rtf_target}), try a smaller model")
+    if persist:
+        opts.whisper_cpu_compute_type = best["compute_type"]
+        opts.whisper_cpu_threads = best["cpu_threads"]
+        opts.whisper_cpu_beams = best["beam_size"]
+        opts.whisper_autotuned_for = _autotune_key(model_size)
+        opts.save_config()
+    return results
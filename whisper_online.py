@@ -34,7 +34,8 @@ class ASRBase:
     sep = " "   # join transcribe words with this character (" " for whisper_timestamped,
                 # "" for faster-whisper because it emits the spaces when neeeded)
 
-    def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr):
+    def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None, logfile=sys.stderr, model=None):
+        """model: an already loaded model to use instead of loading one, or a function that returns the current one, if it can be swapped out (see whisper_models.py)"""
         self.logfile = logfile
 
         self.transcribe_kargs = {}
@@ -43,7 +44,7 @@ class ASRBase:
         else:
             self.original_language = lan
 
-        self.model = self.load_model(modelsize, cache_dir, model_dir)
+        self.model = model if model is not None else self.load_model(modelsize, cache_dir, model_dir)
 
 
     def load_model(self, modelsize, cache_dir):
@@ -105,7 +106,9 @@ class FasterWhisperASR(ASRBase):
     """
 
     sep = ""
+    whisper_device = "cuda"
     whisper_compute_type = "int8_float16"
+    beam_size = 5
 
     def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
         from faster_whisper import WhisperModel
@@ -124,7 +127,7 @@ class FasterWhisperASR(ASRBase):
 
         # or run on GPU with INT8
         # tested: the transcripts were different, probably worse than with FP16, and it was slightly (appx 20%) slower
-        model = WhisperModel(model_size_or_path, device="cuda", compute_type=self.whisper_compute_type)
+        model = WhisperModel(model_size_or_path, device=self.whisper_device, compute_type=self.whisper_compute_type)
 
         # or run on CPU with INT8
         # tested: works, but slow, appx 10-times than cuda FP16
@@ -134,7 +137,10 @@ class FasterWhisperASR(ASRBase):
     def transcribe(self, audio, init_prompt=""):
 
         # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC, min chunk 0.01)
-        segments, info = self.model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=5, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
+        model = self.model() if callable(self.model) else self.model
+        if model is None: # no model loaded, e.g. loading one failed
+            return []
+        segments, info = model.transcribe(audio, language=self.original_language, initial_prompt=init_prompt, beam_size=self.beam_size, word_timestamps=True, condition_on_previous_text=True, **self.transcribe_kargs)
         #print(info)  # info contains language detection result
 
         return list(segments)
@@ -314,6 +320,45 @@ class HypothesisBuffer:
     def complete(self):
         return self.buffer
 
+class AudioBuffer:
+    """ Growable float32 audio buffer backed by one preallocated array. Appending copies only the new samples, trimming the start just moves an index,
+    and view() returns the buffered audio as a contiguous slice of the array without copying it. When the end of the array is reached, the live samples
+    are moved back to the front (or into a bigger array if they don't fit), so over a long session each sample is copied a constant number of times.
+    A view is only valid until the next append """
+    def __init__(self, capacity):
+        self.data = np.empty(max(int(capacity), 1), dtype=np.float32)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, audio):
+        audio = np.asarray(audio, dtype=np.float32).ravel()
+        n = len(audio)
+        if self.end + n > len(self.data):
+            live = self.end - self.start
+            if live + n > len(self.data) // 2:  # would compact again soon, grow instead
+                data = np.empty(max(2 * len(self.data), 2 * (live + n)), dtype=np.float32)
+                data[:live] = self.data[self.start:self.end]
+                self.data = data
+            else:
+                self.data[:live] = self.data[self.start:self.end]  # memmove, the ranges may overlap
+            self.start, self.end = 0, live
+        self.data[self.end:self.end + n] = audio
+        self.end += n
+
+    def trim(self, samples):
+        """ Drops the first samples from the buffer """
+        self.start = min(self.end, self.start + max(int(samples), 0))
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def view(self):
+        return self.data[self.start:self.end]
+
+
 class OnlineASRProcessor:
 
     SAMPLING_RATE = 16000
@@ -328,6 +373,8 @@ class OnlineASRProcessor:
         self.asr = asr
         self.tokenizer = tokenizer
         self.logfile = logfile
+        # room for twice the trimming threshold, so it's rare for the buffer to have to grow. Allocated once, init() only empties it
+        self.audio = AudioBuffer(2 * (buffer_trimming[1] + 15) * self.SAMPLING_RATE)
 
         self.init()
 
@@ -335,14 +382,19 @@ class OnlineASRProcessor:
 
     def init(self):
         """run this when starting or restarting processing"""
-        self.audio_buffer = np.array([],dtype=np.float32)
+        self.audio.clear()
         self.buffer_time_offset = 0
 
         self.transcript_buffer = HypothesisBuffer(logfile=self.logfile)
         self.commited = []
 
+    @property
+    def audio_buffer(self):
+        """the buffered audio, as a view into self.audio"""
+        return self.audio.view()
+
     def insert_audio_chunk(self, audio):
-        self.audio_buffer = np.append(self.audio_buffer, audio)
+        self.audio.append(audio)
 
     def prompt(self):
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer. 
@@ -460,7 +512,7 @@ class OnlineASRProcessor:
         """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds*self.SAMPLING_RATE):]
+        self.audio.trim(int(cut_seconds*self.SAMPLING_RATE))
         self.buffer_time_offset = time
 
     def words_to_sentences(self, words):